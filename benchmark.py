@@ -0,0 +1,228 @@
+"""Reproducible benchmark for the vault_logic hot paths.
+
+Builds a synthetic vault (N notes, a fraction of them secret, a spread of note lengths),
+times every hot path at each size, records peak memory, compares the vector index
+backends (recall@k vs latency), and writes the results as JSON so runs can be compared
+over time. Gemini is replaced by a local stub, so it runs offline.
+
+    python benchmark.py                              # 100, 10k and 100k notes
+    python benchmark.py --sizes 100 1000 --out bench_results
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import vault_logic as vl
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+BENCH_PIN = "1234"
+WORDS = ("vault note secret plan meeting budget travel health goal project idea family "
+         "garden recipe invoice password server deploy backup review sprint launch study "
+         "python streamlit faiss gemini embedding privacy summary export monday friday").split()
+
+# --- 1. GEMINI STUB ---
+class _StubChunk:
+    def __init__(self, text):
+        self.text = text
+
+class _StubModels:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def generate_content_stream(self, model, contents):
+        time.sleep(self.latency)
+        for word in "This is a stubbed answer generated offline for benchmarking .".split():
+            yield _StubChunk(word + " ")
+
+class StubGeminiClient:
+    """Stands in for genai.Client: same `models.generate_content_stream` API, no network"""
+
+    def __init__(self, latency=0.0):
+        self.models = _StubModels(latency)
+
+# --- 2. SYNTHETIC VAULT ---
+def make_sentence(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(6, 18))]
+    return " ".join(words).capitalize() + "."
+
+def make_synthetic_vault(n_notes, secret_fraction, keyring, seed=0, median_words=80):
+    """Returns (stored notes, plain texts); note lengths follow a log-normal spread"""
+    rng = random.Random(seed)
+    notes, texts = [], []
+    for i in range(n_notes):
+        target_words = max(5, int(rng.lognormvariate(0, 1) * median_words))
+        sentences, count = [], 0
+        while count < target_words:
+            sentence = make_sentence(rng)
+            sentences.append(sentence)
+            count += sentence.count(" ") + 1
+        text = " ".join(sentences)
+        secret = rng.random() < secret_fraction
+        texts.append(text)
+        notes.append({"id": i + 1, "title": " ".join(rng.sample(WORDS, 3)).title(),
+                      "content": text, "timestamp": "2026-01-01 10:00", "secret": secret})
+    secret_idx = [i for i, n in enumerate(notes) if n["secret"]]
+    for i, token in zip(secret_idx, keyring.encrypt_many([texts[i] for i in secret_idx])):
+        notes[i]["content"] = token
+    return notes, texts
+
+# --- 3. MEASUREMENT ---
+def measure(name, fn, n_items=None, reset=None):
+    """Runs fn twice: once timed, once under tracemalloc for the Python heap peak (tracing
+    slows allocation-heavy code down a lot, so it never overlaps the timed run). reset(), if
+    given, runs untimed before each pass so both start from the same state. Native
+    allocations (torch, faiss) are only visible in the process-wide max RSS."""
+    if reset:
+        reset()
+    started = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - started
+    if reset:
+        reset()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result = {"name": name, "seconds": round(seconds, 6), "peak_python_kb": round(peak / 1024, 1)}
+    if n_items:
+        result["items"] = n_items
+        result["per_item_ms"] = round(seconds * 1000 / n_items, 4)
+    print(f"  {name:<28} {seconds:9.4f}s" + (f"  ({result['per_item_ms']} ms/item)" if n_items else ""))
+    return result
+
+def max_rss_kb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_size(n_notes, args):
+    print(f"\n== {n_notes} notes ==")
+    keyring = vl.VaultKeyring()
+    keyring.unlock(BENCH_PIN)
+    notes, texts = make_synthetic_vault(n_notes, args.secret_fraction, keyring, seed=args.seed)
+    rng = random.Random(args.seed)
+    sample = rng.sample(range(n_notes), min(args.sample, n_notes))
+    results = []
+
+    # Storage
+    storage = vl.NoteStorage(path=os.path.join(args.workdir, f"bench_{n_notes}.db"), legacy_file=None)
+    results.append(measure("save_notes", lambda: storage.replace_all(notes), n_notes))
+    results.append(measure("load_notes", storage.load, n_notes))
+    one = dict(notes[0], title="edited")
+    results.append(measure("save_note (single)", lambda: storage.upsert(one), 1))
+
+    # Encryption: PIN-based calls run PBKDF2 every time, the keyring derives once
+    results.append(measure("encrypt_data (per PIN call)", lambda: [vl.encrypt_data(texts[i], BENCH_PIN) for i in sample[:args.kdf_sample]], min(args.kdf_sample, len(sample))))
+    secret_tokens = [n["content"] for n in notes if n["secret"]]
+    results.append(measure("decrypt_data (per PIN call)", lambda: [vl.decrypt_data(t, BENCH_PIN) for t in secret_tokens[:args.kdf_sample]], max(1, min(args.kdf_sample, len(secret_tokens)))))
+    results.append(measure("keyring.encrypt_many", lambda: keyring.encrypt_many([texts[i] for i in sample]), len(sample)))
+    results.append(measure("keyring.decrypt_many", lambda: keyring.decrypt_many(secret_tokens), max(1, len(secret_tokens))))
+
+    # Large secret payloads: chunked blob file vs one inline Fernet token (peak memory matters here)
+    big_text = (" ".join(texts[:100]) * (args.blob_chars // 1000 + 1))[:args.blob_chars]
+    keyring.blob_dir = os.path.join(args.workdir, "blobs")
+    blob_holder = {}
+    results.append(measure("blob write (large secret)", lambda: blob_holder.update(id=keyring.write_blob(big_text)), 1))
+    results.append(measure("blob preview (200 chars)", lambda: keyring.read_blob(blob_holder["id"], max_chars=200), 1))
+    results.append(measure("blob read (full)", lambda: keyring.read_blob(blob_holder["id"]), 1))
+    results.append(measure("fernet round trip (large)", lambda: keyring.decrypt(keyring.encrypt(big_text)), 1))
+
+    # Search
+    results.append(measure("get_filtered_notes (scan)", lambda: vl.get_filtered_notes(notes, True, "budget travel"), n_notes))
+    index_holder = {}
+    results.append(measure("SearchIndex build", lambda: index_holder.update(idx=vl.SearchIndex(notes, keyring)), n_notes))
+    results.append(measure("get_filtered_notes (index)", lambda: vl.get_filtered_notes(notes, True, "budget tra", index_holder["idx"]), n_notes))
+
+    # RAG
+    embed_notes = notes if args.embed_limit is None else notes[:args.embed_limit]
+    store_holder = {"passes": 0}
+
+    def fresh_store():  # sync only embeds what changed, so each pass starts from a new, empty store
+        store_holder["passes"] += 1
+        prefix = os.path.join(args.workdir, f"bench_{n_notes}_{store_holder['passes']}")
+        store_holder["store"] = vl.EmbeddingStore(keyring, path=prefix + "_emb.db", index_path=prefix + ".faiss")
+
+    plain_notes = [dict(n, content=t, secret=False) for n, t in zip(embed_notes, texts)]
+    results.append(measure("create_vector_index", lambda: index_holder.update(rag=vl.create_vector_index(plain_notes)), len(plain_notes)))
+    results.append(measure("EmbeddingStore.sync", lambda: store_holder["store"].sync(embed_notes), len(embed_notes), reset=fresh_store))
+    store = store_holder["store"]
+    queries = [make_sentence(rng) for _ in range(args.queries)]
+    rag_index, text_data = index_holder["rag"]
+    results.append(measure("query_vault", lambda: [vl.query_vault(q, rag_index, text_data) for q in queries], len(queries)))
+    store.current()  # Publish the index first, so only the searches are timed
+    results.append(measure("embed_query + store.search", lambda: [store.search(vl.embed_query(q)) for q in queries], len(queries)))
+
+    # Index backends on the same vectors: recall@k against exact search vs latency and size
+    backends = []
+    vectors = store.vectors()
+    if len(vectors) > 1:
+        backends = vl.benchmark_index_backends(vectors, k=args.recall_k, storages=tuple(args.index_storages))
+        for row in backends:
+            print(f"  index {row['kind']:<5} {row['storage']:<8} recall@{args.recall_k} {row['recall_at_k']:.3f}  "
+                  f"{row['query_ms']:.3f} ms/query  {row['index_bytes'] / 1024:.0f} KB  build {row['build_s']}s")
+
+    # The stub answers instantly: lift the real 15 RPM limit so the run times the client path, not the limiter
+    vl.set_gemini_client(StubGeminiClient(args.stub_latency))
+    rate_limiter, vl.gemini_rate_limiter = vl.gemini_rate_limiter, vl.TokenBucket(1e9, 1e9)
+    try:
+        results.append(measure("get_gemini_response (stub)", lambda: [vl.get_gemini_response(q, texts[0][:500]) for q in queries], len(queries)))
+    finally:
+        vl.gemini_rate_limiter = rate_limiter
+
+    # Per-note features
+    results.append(measure("ai_summarize_text", lambda: [vl.ai_summarize_text(texts[i]) for i in sample], len(sample)))
+    results.append(measure("ai_summarize_many", lambda: vl.ai_summarize_many([texts[i] for i in sample]), len(sample)))
+    results.append(measure("create_pdf", lambda: [vl.create_pdf(notes[i]["title"], texts[i]) for i in sample], len(sample)))
+    results.append(measure("create_docx", lambda: [vl.create_docx(notes[i]["title"], texts[i]) for i in sample], len(sample)))
+
+    return {"notes": n_notes, "secret_fraction": args.secret_fraction, "embedded_notes": len(embed_notes),
+            "max_rss_kb": max_rss_kb(), "results": results, "index_backends": backends}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the vault_logic hot paths on synthetic vaults")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 10000, 100000])
+    parser.add_argument("--secret-fraction", type=float, default=0.3)
+    parser.add_argument("--sample", type=int, default=50, help="Notes used for per-note features (summarize, exports)")
+    parser.add_argument("--kdf-sample", type=int, default=10, help="Calls of the PBKDF2-per-call encrypt/decrypt")
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--blob-chars", type=int, default=2_000_000, help="Size of the large secret payload")
+    parser.add_argument("--embed-limit", type=int, default=None, help="Embed only the first N notes (CPU-bound)")
+    parser.add_argument("--stub-latency", type=float, default=0.0, help="Seconds the Gemini stub waits per call")
+    parser.add_argument("--index-storages", nargs="+", default=["float32", "int8"], choices=sorted(vl.STORAGE_FACTORY),
+                        help="Storage modes compared by the index backend report (pq trains slowly)")
+    parser.add_argument("--recall-k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="bench_results")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    out_path = os.path.abspath(os.path.join(args.out, f"bench_{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"))
+    original_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        args.workdir = workdir
+        os.chdir(workdir)  # Usage stats and other side files land in the temp dir
+        try:
+            runs = [run_size(n, args) for n in args.sizes]
+            vl.get_usage_tracker().close()
+        finally:
+            os.chdir(original_dir)
+
+    report = {"created": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+              "platform": platform.platform(), "machine": platform.machine(),
+              "settings": {k: v for k, v in vars(args).items() if k != "workdir"}, "runs": runs}
+    with open(out_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {out_path}")
+
+if __name__ == "__main__":
+    main()
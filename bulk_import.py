@@ -0,0 +1,254 @@
+"""Headless bulk import of notes into the vault.
+
+Reads a directory, a .zip or .tar(.gz) archive of .txt/.md/.docx files, or a JSONL dump
+(one {"title", "content", "secret", "timestamp"} object per line) as a stream of batches:
+files are parsed in a process pool, secret notes are encrypted with a key derived once,
+each batch is committed in one SQLite transaction together with the list of sources it
+covered, and the batch is embedded before the next one is read. Re-running the same
+command resumes after the last committed batch; notes whose content is already in the
+vault are skipped (plain notes by SHA-256, secret notes by an HMAC keyed from the PIN).
+
+    python bulk_import.py notes_dir/
+    python bulk_import.py export.zip --secret --pin 1234
+    python bulk_import.py dump.jsonl --no-embed
+
+A running app picks the new notes up on its next rerun.
+"""
+import argparse
+import getpass
+import hashlib
+import io
+import json
+import os
+import tarfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import vault_logic as vl
+
+IMPORT_EXTENSIONS = (".txt", ".md", ".docx")
+IMPORT_BATCH_SIZE = 1000
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M"  # Same format the sidebar form writes
+
+# --- 1. READERS ---
+# Each reader yields (source key, file name, raw bytes or a JSONL line, mtime) one item at
+# a time, so only the current batch is ever held in memory.
+def _iter_directory(path):
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMPORT_EXTENSIONS):
+                full = os.path.join(root, name)
+                with open(full, "rb") as f:
+                    yield os.path.relpath(full, path), name, f.read(), os.path.getmtime(full)
+
+def _iter_zip(path):
+    with zipfile.ZipFile(path) as zf:
+        for info in zf.infolist():
+            if not info.is_dir() and info.filename.lower().endswith(IMPORT_EXTENSIONS):
+                mtime = datetime(*info.date_time).timestamp()
+                yield info.filename, os.path.basename(info.filename), zf.read(info), mtime
+
+def _iter_tar(path):
+    with tarfile.open(path, "r:*") as tf:
+        for member in tf:  # Streams even through .tar.gz
+            if member.isfile() and member.name.lower().endswith(IMPORT_EXTENSIONS):
+                yield member.name, os.path.basename(member.name), tf.extractfile(member).read(), member.mtime
+
+def _iter_jsonl(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if line.strip():
+                yield f"line:{line_no}", None, line, None
+
+def iter_source(path):
+    """Picks the reader for a directory, archive or JSONL file"""
+    lower = path.lower()
+    if os.path.isdir(path):
+        return _iter_directory(path)
+    if lower.endswith(".zip"):
+        return _iter_zip(path)
+    if lower.endswith((".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")):
+        return _iter_tar(path)
+    if lower.endswith((".jsonl", ".ndjson")):
+        return _iter_jsonl(path)
+    raise ValueError(f"Don't know how to import {path}: expected a directory, .zip, .tar(.gz) or .jsonl")
+
+# --- 2. PARSING (runs in the worker processes) ---
+def _docx_text(raw):
+    from docx import Document
+    return "\n".join(p.text for p in Document(io.BytesIO(raw)).paragraphs)
+
+def parse_item(item, default_secret=False):
+    """Turns one raw item into {"title", "content", "secret", "timestamp"}; None if unusable"""
+    source, name, raw, mtime = item
+    try:
+        if name is None:  # JSONL record
+            record = json.loads(raw)
+            title = str(record.get("title") or "Imported note")
+            content = str(record.get("content") or "")
+            secret = bool(record.get("secret", default_secret))
+            timestamp = record.get("timestamp") or datetime.now().strftime(TIMESTAMP_FORMAT)
+        else:
+            stem, ext = os.path.splitext(name)
+            content = _docx_text(raw) if ext.lower() == ".docx" else raw.decode("utf-8", errors="replace")
+            title, secret = stem, default_secret
+            timestamp = datetime.fromtimestamp(mtime).strftime(TIMESTAMP_FORMAT)
+    except Exception as e:
+        return {"error": f"{source}: {e}"}
+    if not title.strip() and not content.strip():
+        return None
+    return {"title": title, "content": content, "secret": secret, "timestamp": timestamp}
+
+def _parse_batch(args):
+    batch, default_secret = args
+    return [parse_item(item, default_secret) for item in batch]
+
+# --- 3. PIPELINE ---
+def content_digest(text, secret, keyring=None):
+    """Dedup key: plain SHA-256 for normal notes, keyed HMAC for secret ones (no plaintext hash on disk)"""
+    if secret:
+        return "hmac:" + keyring.fingerprint(text)
+    return "sha256:" + hashlib.sha256(text.encode()).hexdigest()
+
+def existing_digests(storage, keyring=None):
+    """Digests of every note already in the vault (one streaming pass, secret notes decrypted in bulk)"""
+    digests = set()
+    for batch in storage.iter_batches(batch_size=5000):
+        texts = vl.get_notes_text(batch, keyring)
+        for note, text in zip(batch, texts):
+            if note.get('secret') and (keyring is None or text == vl.DECRYPTION_ERROR):
+                continue  # Can't fingerprint what we can't read
+            digests.add(content_digest(text, note.get('secret'), keyring))
+    return digests
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def bulk_import(path, pin=None, secret=False, embed=True, batch_size=IMPORT_BATCH_SIZE,
+                workers=None, progress=None, vault=None):
+    """Imports every note under path into vault (default: the single-user vault). pin is
+    required for secret notes and for embedding. progress(stats) is called after each
+    committed batch. Returns the stats."""
+    vault = vault or vl.get_default_vault()
+    vault.check_writable()  # Not while a PIN change is half done: new secret notes would miss it
+    storage = vault.storage
+    keyring = vl.VaultKeyring()
+    if pin is not None:
+        if not vault.verify_pin(pin):
+            raise ValueError("Incorrect PIN")
+        vault.unlock(keyring, pin)  # PBKDF2 runs once for the whole import
+    elif secret:
+        raise ValueError("Importing secret notes needs the vault PIN")
+
+    source_prefix = os.path.abspath(path) + "::"
+    seen = existing_digests(storage, keyring if keyring.is_unlocked else None)
+    # Without the key the store couldn't keep the saved vectors of secret notes, so embedding
+    # needs the PIN; otherwise the app embeds the new notes on its next unlock
+    store = vault.embedding_store(keyring) if embed and keyring.is_unlocked else None
+    stats = {"read": 0, "imported": 0, "duplicates": 0, "resumed": 0, "failed": 0, "errors": [],
+             "embedded": 0, "started": time.time()}
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Parsing of the next batch overlaps with encrypting/committing/embedding this one
+        raw_batches = _batches(iter_source(path), batch_size)
+        pending = None
+        while True:
+            batch = next(raw_batches, None)
+            if batch is not None:
+                done = storage.imported_sources(source_prefix + item[0] for item in batch)
+                stats["resumed"] += len(done)
+                batch = [item for item in batch if source_prefix + item[0] not in done]
+                stats["read"] += len(batch)
+                chunks = [batch[i:i + 64] for i in range(0, len(batch), 64)]
+                future = pool.map(_parse_batch, [(chunk, secret) for chunk in chunks])
+            if pending is not None:
+                _commit_batch(pending, storage, keyring, store, seen, source_prefix, stats)
+                if progress:
+                    progress(stats)
+            if batch is None:
+                break
+            pending = (batch, [note for chunk in future for note in chunk])
+
+    if store is not None:
+        store.save()
+    vault.reload()
+    stats["seconds"] = round(time.time() - stats.pop("started"), 2)
+    return stats
+
+def _commit_batch(pending, storage, keyring, store, seen, source_prefix, stats):
+    items, parsed = pending
+    notes, sources = [], []
+    for item, note in zip(items, parsed):
+        source = source_prefix + item[0]
+        if note is None or "error" in note:
+            if note is not None:
+                stats["failed"] += 1
+                stats["errors"].append(note["error"])
+            sources.append((source, None))
+            continue
+        if note["secret"] and not keyring.is_unlocked:
+            stats["failed"] += 1
+            stats["errors"].append(f"{item[0]}: secret note needs the PIN")
+            continue  # Not recorded: a later run with --pin can still import it
+        digest = content_digest(note["content"], note["secret"], keyring)
+        if digest in seen:
+            stats["duplicates"] += 1
+            sources.append((source, None))
+            continue
+        seen.add(digest)
+        notes.append(note)
+        sources.append((source, note))  # Its id is assigned inside the commit transaction
+
+    secret_notes = [n for n in notes if n["secret"] and len(n["content"]) < vl.BLOB_THRESHOLD_CHARS]
+    for note, token in zip(secret_notes, keyring.encrypt_many([n["content"] for n in secret_notes])):
+        note["content"] = token
+    for note in notes:
+        if note["secret"] and len(note["content"]) >= vl.BLOB_THRESHOLD_CHARS:
+            vl.set_note_content(note, note["content"], True, keyring)  # Chunk-encrypted blob file
+    storage.import_batch(notes, sources)
+    stats["imported"] += len(notes)
+
+    if store is not None and notes:
+        stats["embedded"] += store.upsert_many(notes)  # One large encode pass per batch, saved right away
+
+# --- 4. CLI ---
+def main():
+    parser = argparse.ArgumentParser(description="Import a directory, archive or JSONL dump of notes into the vault")
+    parser.add_argument("source", help="Directory, .zip, .tar(.gz) or .jsonl file")
+    parser.add_argument("--secret", action="store_true", help="Store every imported file as a secret note")
+    parser.add_argument("--pin", default=os.getenv("VAULT_PIN"), help="Vault PIN (or VAULT_PIN; prompted for with --secret)")
+    parser.add_argument("--no-embed", action="store_true", help="Skip embeddings (the app builds them on next unlock; also skipped without a PIN)")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=None, help="Parser processes (default: CPU count)")
+    parser.add_argument("--tenant", default=None, help="Import into this user's vault (multi-tenant mode)")
+    args = parser.parse_args()
+
+    vault = vl.get_tenant_registry().get(args.tenant) if args.tenant else vl.get_default_vault()
+    if not vault.is_initialized():
+        parser.error("The vault has no PIN yet: open the app once to set it up")
+    pin = args.pin
+    if pin is None and args.secret:
+        pin = getpass.getpass("Vault PIN: ")
+
+    def report(stats):
+        print(f"\r  read {stats['read']}  imported {stats['imported']}  duplicates {stats['duplicates']}  "
+              f"resumed {stats['resumed']}  failed {stats['failed']}", end="", flush=True)
+
+    stats = bulk_import(args.source, pin=pin, secret=args.secret, embed=not args.no_embed,
+                        batch_size=args.batch_size, workers=args.workers, progress=report, vault=vault)
+    print(f"\nDone in {stats['seconds']}s ({stats['embedded']} notes embedded)")
+    for error in stats["errors"][:20]:
+        print(f"  ! {error}")
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,35 @@ import streamlit as st
 from datetime import datetime
 import vault_logic as vl
 import time
-import json
-import os
 
 # --- CONFIGURATION ---
 AUTO_LOCK_SECONDS = 150  # 2 Minutes
 
 st.set_page_config(page_title="AI Vault", layout="wide")
+rerun_timer = vl.PhaseTimer("ui") # Per-phase rerun latency (no-op unless metrics are on)
+
+# --- VAULT SELECTION ---
+if vl.MULTI_TENANT:
+    # Server mode: one vault per logged-in user (st.login needs an [auth] section in secrets.toml)
+    if not st.user.is_logged_in:
+        st.title("🔒 AI Vault")
+        st.button("Log in", on_click=st.login, type="primary")
+        st.stop()
+    vault = vl.get_tenant_registry().get(st.user.get("email") or st.user.get("sub"))
+else:
+    vault = vl.get_default_vault()
+vl.use_usage_tracker(vault.usage) # Token/cost counts of this run go to this vault
+vault.refresh() # Picks up notes written by another process (e.g. bulk_import.py)
+
+if st.session_state.get("vault_root", vault.root) != vault.root:
+    # Someone else signed in on this browser session: nothing of the previous user survives
+    if st.session_state.get("keyring") is not None:
+        st.session_state.keyring.lock() # The previous vault drops its shared store once no session holds the key
+    st.session_state.clear()
+st.session_state.vault_root = vault.root
 
 # --- 0. FIRST TIME SETUP ---
-if not vl.is_vault_initialized():
+if not vault.is_initialized():
     st.title("🔒 Initialize Your Secure Vault")
     
     # 1. Primary Action: The PIN Box
@@ -41,8 +60,8 @@ if not vl.is_vault_initialized():
             <p style="color: #ff4b4b; font-weight: bold; margin-bottom: 5px;">🛑 Important Security Notice:</p>
             <p style="font-size: 0.9rem; margin-bottom: 10px;">
                 This vault utilizes <b>Zero-Knowledge AES-Encryption</b>. Your PIN is never stored; it is only hashed. 
-                While the Recovery Key can reset app access, it <b>cannot decrypt</b> existing secret data 
-                locked with a different PIN.
+                While the Recovery Key can reset app access, it <b>cannot decrypt</b> existing secret data: 
+                secret notes only open again if you set the same PIN as before.
             </p>
             <p style="font-size: 0.8rem; opacity: 0.8;">
                 <i>The developer holds no responsibility for data loss resulting from forgotten credentials.</i>
@@ -52,7 +71,7 @@ if not vl.is_vault_initialized():
             
     if submit:        
         if new_pin == conf_pin and len(new_pin) >= 4:
-            vl.initialize_vault(new_pin, st.session_state.generated_recovery)
+            vault.initialize(new_pin, st.session_state.generated_recovery)
             st.success("Vault Securely Initialized! Refreshing...")
             time.sleep(1.5)
             st.rerun()
@@ -61,14 +80,28 @@ if not vl.is_vault_initialized():
     st.stop()
 
 # --- 1. SESSION STATE ---
-if 'notes' not in st.session_state:
-    st.session_state.notes = vl.load_notes()
+# The notes themselves live in `vault.notes`, shared by every session of the vault, and so
+# do the embedding store and the search index (see vault.embedding_worker / search_index)
 if 'edit_note_id' not in st.session_state:
     st.session_state.edit_note_id = None
 if 'vault_unlocked' not in st.session_state:
     st.session_state.vault_unlocked = False
-if 'master_pin' not in st.session_state:
-    st.session_state.master_pin = "" # We store the actual PIN in session only while unlocked
+if 'keyring' not in st.session_state:
+    st.session_state.keyring = vl.VaultKeyring() # Holds the derived key in session only while unlocked
+if 'export_cache' not in st.session_state:
+    st.session_state.export_cache = vl.ExportCache()
+if 'summary_cache' not in st.session_state:
+    st.session_state.summary_cache = vl.SummaryCache()
+if 'pending_export' not in st.session_state:
+    st.session_state.pending_export = None
+if 'bulk_export' not in st.session_state:
+    st.session_state.bulk_export = None
+if 'note_lists' not in st.session_state:
+    st.session_state.note_lists = vl.NoteListMemo()
+if 'grid_page' not in st.session_state:
+    st.session_state.grid_page = 1
+if 'grid_query' not in st.session_state:
+    st.session_state.grid_query = ""
 if 'temp_content' not in st.session_state:
     st.session_state.temp_content = ""
 if 'form_iteration' not in st.session_state:
@@ -78,19 +111,51 @@ if 'last_activity' not in st.session_state:
 if 'show_lock_alert' not in st.session_state:
     st.session_state.show_lock_alert = False
 
+rerun_timer.mark("session_state")
+
 # --- 2. AUTO-LOCK ENGINE ---
 def update_activity():
     st.session_state.last_activity = time.time()
     st.session_state.show_lock_alert = False 
 
-if st.session_state.vault_unlocked:
-    elapsed_time = time.time() - st.session_state.last_activity
-    if elapsed_time > AUTO_LOCK_SECONDS:
-        st.session_state.vault_unlocked = False
-        st.session_state.edit_note_id = None
-        st.session_state.temp_content = "" 
-        st.session_state.show_lock_alert = True 
-        st.rerun() 
+def auto_lock_due():
+    return st.session_state.vault_unlocked and time.time() - st.session_state.last_activity > AUTO_LOCK_SECONDS
+
+def start_embedding_worker():
+    # Embeddings are (re)built in the background; the AI panel uses whatever index is ready
+    return vault.embedding_worker(st.session_state.keyring)
+
+def lock_vault():
+    # Drops the key and everything that holds decrypted data or was built from it (the
+    # vault's shared store and index go when the last unlocked session locks)
+    st.session_state.vault_unlocked = False
+    vault.detach(st.session_state.keyring)
+    st.session_state.keyring.lock()
+    st.session_state.export_cache.clear()
+    st.session_state.summary_cache.clear()
+    st.session_state.pending_export = None
+    st.session_state.bulk_export = None
+    st.session_state.note_lists.clear()
+
+if st.session_state.vault_unlocked and not vault.keyring_current(st.session_state.keyring):
+    # The PIN was changed in another session: this key can't read or write secret notes any more
+    lock_vault()
+    st.session_state.edit_note_id = None
+    st.session_state.temp_content = ""
+    st.warning("The vault PIN was changed. Unlock again with the new PIN.")
+
+if auto_lock_due():
+    lock_vault()
+    st.session_state.edit_note_id = None
+    st.session_state.temp_content = "" 
+    st.session_state.show_lock_alert = True 
+    st.rerun() 
+
+# Fragments rerun on their own, without the code above: they hand over to a full rerun
+# when the vault should lock, so auto-lock still happens on the next click
+def check_auto_lock():
+    if auto_lock_due():
+        st.rerun(scope="app")
 
 # --- 3. CSS & ALERTS ---
 st.markdown("""
@@ -104,15 +169,18 @@ if st.session_state.show_lock_alert:
     st.error("🚨 **THE VAULT IS AUTO LOCKED**")
 
 # --- 4. SIDEBAR ---
-with st.sidebar:
-    st.title("➕ Add/Edit Note")
+# The editor is its own fragment: typing, summarizing or a failed save only reruns the form
+@st.fragment
+@vl.instrument("ui.fragment.editor")
+def note_editor():
+    check_auto_lock()
     
     c_title, c_content, c_secret = "", "", False
     if st.session_state.edit_note_id:
-        n = next((x for x in st.session_state.notes if x['id'] == st.session_state.edit_note_id), None)
+        n = next((x for x in vault.notes if x['id'] == st.session_state.edit_note_id), None)
         if n: 
             c_title = n['title']
-            c_content = vl.decrypt_data(n['content'], st.session_state.master_pin) if (n.get('secret') and st.session_state.vault_unlocked) else n['content']
+            c_content = vl.get_note_text(n, st.session_state.keyring)
             c_secret = n.get('secret', False)
 
     default_content = st.session_state.temp_content if st.session_state.temp_content else c_content
@@ -125,37 +193,53 @@ with st.sidebar:
         if st.form_submit_button("✨ AI Summarize"):
             update_activity()
             if new_c:
-                summary_result = vl.ai_summarize_text(new_c)
+                summary_result = vl.ai_summarize_text(new_c, cache=st.session_state.summary_cache)
                 st.session_state.temp_content = summary_result
-                st.rerun() 
+                st.rerun(scope="fragment") 
         
         if st.form_submit_button("Save", type="primary", use_container_width=True):
             update_activity()
-            if new_t or new_c:
+            if c_content == vl.DECRYPTION_ERROR:
+                # Saving would replace the ciphertext with the error text (e.g. mid PIN change)
+                st.error("This note can't be decrypted with the current key, so it can't be saved.")
+            elif new_t or new_c:
                 ts = datetime.now().strftime("%Y-%m-%d %H:%M")
-                final_content = vl.encrypt_data(new_c, st.session_state.master_pin) if m_secret else new_c
+                saved_note = None
                 if st.session_state.edit_note_id:
-                    for n in st.session_state.notes:
-                        if n['id'] == st.session_state.edit_note_id:
-                            n.update({"title": new_t, "content": final_content, "timestamp": ts, "secret": m_secret})
-                    st.session_state.edit_note_id = None
+                    n = next((x for x in vault.notes if x['id'] == st.session_state.edit_note_id), None)
+                    if n:
+                        saved_note = {**n, "title": new_t, "timestamp": ts}
                 else:
-                    st.session_state.notes.insert(0, {"id": int(datetime.now().timestamp()), "title": new_t, "content": final_content, "timestamp": ts, "secret": m_secret})
+                    saved_note = {"title": new_t, "timestamp": ts} # save_note assigns the id
                 
-                vl.save_notes(st.session_state.notes)
+                if saved_note is not None:
+                    try:
+                        vault.check_writable(st.session_state.keyring, m_secret)
+                        # Large secret notes go to a chunk-encrypted blob file, the rest stays inline
+                        vl.set_note_content(saved_note, new_c, m_secret, st.session_state.keyring)
+                        vault.save_note(saved_note, st.session_state.keyring) # Only this note, under the vault's write lock
+                    except ValueError as e:
+                        st.error(str(e))
+                        return
+                st.session_state.edit_note_id = None
                 st.session_state.temp_content = "" 
                 st.session_state.form_iteration += 1 
-                st.rerun()
+                st.rerun(scope="app") # The grid and the search index have to see the change
+
+with st.sidebar:
+    st.title("➕ Add/Edit Note")
+    note_editor()
 
     st.divider()
     st.write("### 🔐 Vault Security")
     if not st.session_state.vault_unlocked:
         pin_input = st.text_input("Enter Stealth PIN", type="password", key="pin_entry")
         if pin_input:
-            if vl.verify_pin(pin_input):
+            if vault.verify_pin(pin_input):
                 update_activity()
                 st.session_state.vault_unlocked = True
-                st.session_state.master_pin = pin_input
+                vault.unlock(st.session_state.keyring, pin_input) # Secret notes become searchable
+                start_embedding_worker()
                 st.rerun()
             else: st.error("Incorrect PIN")
 
@@ -163,10 +247,10 @@ with st.sidebar:
         with st.expander("Forgot PIN?"):
             recovery_in = st.text_input("Enter Recovery Key")
             if st.button("Reset Vault PIN"):
-                # Logic: If recovery key matches, delete config so they can start over
+                # Logic: If recovery key matches, forget the PIN (the salt stays) so they can start over
                 # Note: Old encrypted notes stay encrypted (this is the cost of security!)
-                if vl.verify_recovery_key(recovery_in): # You'll add this to vault_logic
-                    os.remove("vault_config.json")
+                if vault.verify_recovery_key(recovery_in):
+                    vault.reset_identity()
                     st.warning("Vault Identity Reset. Please refresh to set a new PIN.")
                     st.rerun()
 
@@ -175,48 +259,136 @@ with st.sidebar:
         time_left = int(AUTO_LOCK_SECONDS - (time.time() - st.session_state.last_activity))
         st.caption(f"Auto-locking in {max(0, time_left)}s")
         if st.button("🔒 Close Vault", use_container_width=True):
-            st.session_state.vault_unlocked = False
-            st.session_state.master_pin = ""
+            lock_vault()
             st.rerun()
 
+        pending_rotation = vault.pending_rotation()
+        with st.expander("🔑 Change PIN", expanded=pending_rotation is not None):
+            if pending_rotation:
+                st.warning(f"A PIN change started {pending_rotation['started']} was interrupted. "
+                           "Enter the same new PIN to resume it, or roll it back.")
+            old_pin = st.text_input("Current PIN", type="password", key="rotate_old")
+            new_pin = st.text_input("New PIN", type="password", key="rotate_new")
+            confirm_pin = st.text_input("Confirm New PIN", type="password", key="rotate_confirm")
+            c_go, c_back = st.columns(2)
+            if c_go.button("Resume" if pending_rotation else "Change PIN", use_container_width=True):
+                update_activity()
+                if not new_pin or new_pin != confirm_pin:
+                    st.error("New PINs don't match")
+                else:
+                    progress = st.empty()
+                    try:
+                        counts = vault.change_pin(old_pin, new_pin, progress=lambda c: progress.caption(f"Re-encrypted {c['done']} secret notes..."))
+                    except (ValueError, RuntimeError) as e:
+                        st.error(str(e))
+                    else:
+                        # Derived caches were encrypted with the old key: start them over with the new one
+                        lock_vault()
+                        vault.unlock(st.session_state.keyring, new_pin)
+                        st.session_state.vault_unlocked = True
+                        start_embedding_worker()
+                        st.success(f"PIN changed ({counts['done']} secret notes re-encrypted)")
+            if pending_rotation and c_back.button("Roll Back", use_container_width=True):
+                update_activity()
+                try:
+                    vault.rollback_pin_change(old_pin, new_pin)
+                except ValueError as e:
+                    st.error(str(e))
+                else:
+                    st.rerun()
+
+    if vl.MULTI_TENANT:
+        st.caption(f"Signed in as {vault.name}")
+        st.button("Log out", on_click=st.logout, use_container_width=True)
+
     st.divider()
     st.subheader("📊 AI Resources")
-    if os.path.exists("usage_stats.json"):
-        with open("usage_stats.json", "r") as f:
-            stats = json.load(f)
+    stats = vault.usage.snapshot() # Served from memory, no file read per rerun
+    if stats["total_tokens"] > 0:
         col1, col2 = st.columns(2)
         col1.metric("Tokens", f"{int(stats['total_tokens'])}")
         col2.metric("Cost", f"${stats['total_cost']:.5f}")
+        cache_stats = stats["answer_cache"]
+        col3, col4 = st.columns(2)
+        col3.metric("Cache Hits", cache_stats["hits"])
+        col4.metric("Cache Misses", cache_stats["misses"])
     else:
         st.info("No AI usage data yet.")
 
+    startup = vl.get_startup_report()
+    if startup["events"]:
+        with st.expander("⏱️ Startup Timing"):
+            for name, secs in {**startup["events"], **startup["components"]}.items():
+                st.caption(f"{name}: {secs:.2f}s")
+
+    show_metrics = st.toggle("📈 Performance Metrics", value=vl.metrics.enabled)
+    if show_metrics != vl.metrics.enabled:
+        vl.enable_metrics(show_metrics)
+    if show_metrics:
+        rows = vl.metrics.summary()
+        if rows:
+            st.dataframe(rows, hide_index=True, use_container_width=True)
+        else:
+            st.caption("Collecting... interact with the app to see timings.")
+        m_col1, m_col2 = st.columns(2)
+        m_col1.download_button("JSON", data=vl.metrics.to_json(), file_name="vault_metrics.json", use_container_width=True)
+        m_col2.download_button("Prometheus", data=vl.metrics.to_prometheus(), file_name="vault_metrics.prom", use_container_width=True)
+
+rerun_timer.mark("sidebar")
+
 # --- 5. MAIN PAGE ---
 st.title(vl.get_page_heading(st.session_state.vault_unlocked))
 
 # --- 6. RAG CHAT INTERFACE ---
-if st.session_state.vault_unlocked:
+# A fragment: asking a question or giving feedback doesn't rerun the sidebar or the grid
+@st.fragment
+@vl.instrument("ui.fragment.rag")
+def rag_panel():
+    check_auto_lock()
     with st.expander("💬 Ask Your Vault (AI Search)", expanded=False):
         user_query = st.text_input("Ask a question about your notes:", placeholder="e.g., What are my goals for 2026?")
         
         if user_query:
             update_activity()
-            # 1. Prepare Decrypted Context
-            decrypted_texts = []
-            for n in st.session_state.notes:
-                content = vl.decrypt_data(n['content'], st.session_state.master_pin) if n.get('secret') else n['content']
-                decrypted_texts.append(content)
+            # 1. Use whatever index the background worker has ready (only new/changed notes get embedded)
+            embed_worker = start_embedding_worker() # Already running unless this is the first question
+            embed_store = embed_worker.store
+            worker_status = embed_worker.status()
+            if worker_status["pending"]:
+                st.caption(f"⏳ Index is updating: {worker_status['pending']} change(s) pending, oldest {worker_status['stale_seconds']:.0f}s ago. Answers may miss recent edits.")
+            if worker_status["error"]:
+                st.warning(f"Indexing error: {worker_status['error']}")
             
-            # 2. RAG Logic
-            index, text_data = vl.create_vector_index([{"content": t} for t in decrypted_texts])
-            context_chunks = vl.query_vault(user_query, index, text_data)
+            answer_cache = vault.answer_cache(st.session_state.keyring) # Shared with the vault's other sessions
             
-            # 3. AI Answer
-            context_str = "\n".join(context_chunks)
-            prompt = f"Using ONLY these notes:\n{context_str}\n\nAnswer this question: {user_query}"
+            footprint = embed_store.footprint()
+            st.caption(f"Index: {footprint['vectors']} vectors, {footprint['index_bytes'] / 1024:.0f} KB ({footprint['storage']})")
+            
+            # 2. RAG Logic (the index is already built; the question is embedded once)
+            query_vector = vl.embed_query(user_query)
+            hits = embed_store.search(query_vector, top_k=vl.RAG_TOP_K)
+            context_str, context_note_ids = vl.build_context(hits) # Best chunks, within the token budget
+            if not context_str.strip(): # No index yet (first unlock) or nothing to search: don't ask Gemini blind
+                if vault.notes:
+                    st.info("⏳ The AI index is still being built. Ask again in a moment.")
+                else:
+                    st.info("Your vault has no notes to search yet.")
+                return
+            
+            # 3. AI Answer (reused from the cache when a similar question had the same context)
+            context_key = vl.content_hash(context_str)
             
             with st.spinner("Searching Vault..."):
-                answer = vl.get_gemini_response(user_query, context_str)
-                st.info(f"**AI Answer:**\n{answer}")
+                st.markdown("**AI Answer:**")
+                answer = answer_cache.lookup(query_vector, context_key)
+                if answer is not None:
+                    st.info(answer)
+                    st.caption("⚡ Cached answer")
+                else:
+                    stream_status = {}
+                    answer = st.write_stream(vl.stream_gemini_response(user_query, context_str, stream_status))
+                    if stream_status["complete"]: # A partial or failed answer is shown but never cached
+                        answer_cache.store(query_vector, context_key, context_note_ids, answer)
 
                 # 4. Feedback System ---
                 st.write("---")
@@ -224,48 +396,123 @@ if st.session_state.vault_unlocked:
                 f_col1, f_col2 = st.columns([1, 5])
                 
                 if f_col1.button("✅ Yes", key="fb_yes"):
-                    vl.log_feedback(user_query, answer, context_str, "Correct")
+                    vl.log_feedback(user_query, answer, context_str, "Correct", log=vault.feedback)
                     st.success("Thanks for the feedback!")
                     
                 if f_col2.button("❌ No / Wrong", key="fb_no"):
-                    vl.log_feedback(user_query, answer, context_str, "Wrong")
+                    vl.log_feedback(user_query, answer, context_str, "Wrong", log=vault.feedback)
                     st.warning("Logged as a failure.")
 
+if st.session_state.vault_unlocked:
+    rag_panel()
+
+rerun_timer.mark("rag_panel")
+
 st.divider()
-search = st.text_input("🔍 Search...", placeholder="Filter notes...")
+with st.expander("📦 Export All Notes", expanded=False):
+    e_fmt = st.selectbox("Format", ["ZIP (.txt files)", "ZIP (.pdf files)", "ZIP (.docx files)", "Single PDF", "Single DOCX"])
+    if st.button("Build Export"):
+        update_activity()
+        visible_notes = st.session_state.note_lists.filtered(vault.notes, vault.version,
+                                                             st.session_state.vault_unlocked, "")
+        with st.spinner("Exporting..."):
+            if e_fmt.startswith("ZIP"):
+                inner = {"ZIP (.txt files)": "txt", "ZIP (.pdf files)": "pdf", "ZIP (.docx files)": "docx"}[e_fmt]
+                st.session_state.bulk_export = ("vault_export.zip", vl.export_vault_zip(visible_notes, st.session_state.keyring, inner))
+            elif e_fmt == "Single PDF":
+                st.session_state.bulk_export = ("vault_export.pdf", vl.export_vault_pdf(visible_notes, st.session_state.keyring))
+            else:
+                st.session_state.bulk_export = ("vault_export.docx", vl.export_vault_docx(visible_notes, st.session_state.keyring))
+    if st.session_state.bulk_export:
+        file_name, export_file = st.session_state.bulk_export
+        export_file.seek(0)
+        st.download_button(f"⬇️ Download {file_name}", data=export_file, file_name=file_name, key="bulk_dl")
 
 # --- 7. Display Grid ---
-cols = st.columns(3)
-filtered = vl.get_filtered_notes(st.session_state.notes, st.session_state.vault_unlocked, search)
+# Search box, pager and cards rerun as one fragment. Only the current page is decrypted
+# and rendered, and the filtered list is memoized until the notes or the query change.
+def grid_pager(n_pages, key):
+    prev_col, info_col, next_col = st.columns([1, 3, 1])
+    if prev_col.button("◀ Prev", key=f"prev_{key}", disabled=st.session_state.grid_page <= 1, use_container_width=True):
+        st.session_state.grid_page -= 1
+        st.rerun(scope="fragment")
+    info_col.caption(f"Page {st.session_state.grid_page} of {n_pages}")
+    if next_col.button("Next ▶", key=f"next_{key}", disabled=st.session_state.grid_page >= n_pages, use_container_width=True):
+        st.session_state.grid_page += 1
+        st.rerun(scope="fragment")
+
+@st.fragment
+@vl.instrument("ui.fragment.grid")
+def notes_grid():
+    check_auto_lock()
+    search = st.text_input("🔍 Search...", placeholder="Filter notes...")
+    if search != st.session_state.grid_query:
+        st.session_state.grid_query = search
+        st.session_state.grid_page = 1
+
+    search_index = None
+    if search.strip(): # Built on the first search, not on every first render, unlock or reload
+        with st.spinner("Indexing notes..."):
+            search_index = vault.search_index()
+    filtered = st.session_state.note_lists.filtered(vault.notes, vault.version, st.session_state.vault_unlocked,
+                                                    search, search_index, limit=vl.SEARCH_RESULT_LIMIT)
+    page_notes, st.session_state.grid_page, n_pages = vl.paginate(filtered, st.session_state.grid_page)
+    previews = vl.get_notes_preview(page_notes, st.session_state.keyring) # This page only, blobs up to 200 chars
+    total = getattr(filtered, "total", len(filtered)) # Index searches also say how many matched in all
+    if getattr(filtered, "truncated", False):
+        st.caption(f"Top {len(filtered)} of {total}+ matches: the search is very broad, keep typing to narrow it")
+    elif total > len(filtered):
+        st.caption(f"Top {len(filtered)} of {total} matches")
+    else:
+        st.caption(f"{len(filtered)} notes")
+    if n_pages > 1:
+        grid_pager(n_pages, "top")
 
-for idx, note in enumerate(filtered):
-    with cols[idx % 3]: 
-        with st.container(border=True):
-            display_content = vl.decrypt_data(note['content'], st.session_state.master_pin) if (note.get('secret') and st.session_state.vault_unlocked) else note['content']
+    cols = st.columns(3)
+    for idx, note in enumerate(page_notes):
+        with cols[idx % 3]: 
+            with st.container(border=True):
             
-            st.subheader(f"🔒 {note['title']}" if note.get('secret') else note['title'])
-            st.write(display_content[:200] + "..." if len(display_content) > 200 else display_content)
-            st.caption(f"🕒 {note['timestamp']}")
+                st.subheader(f"🔒 {note['title']}" if note.get('secret') else note['title'])
+                st.write(previews[idx])
+                st.caption(f"🕒 {note['timestamp']}")
             
-            eb, db = st.columns(2)
-            with eb:
-                if st.button("✏️ Edit", key=f"e_{note['id']}"):
-                    update_activity()
-                    st.session_state.edit_note_id = note['id']
-                    st.rerun()
-            with db:
-                if st.button("🗑️ Delete", key=f"d_{note['id']}"):
-                    st.session_state.notes = [x for x in st.session_state.notes if x['id'] != note['id']]
-                    vl.save_notes(st.session_state.notes)
-                    st.rerun()
+                eb, db = st.columns(2)
+                with eb:
+                    if st.button("✏️ Edit", key=f"e_{note['id']}"):
+                        update_activity()
+                        st.session_state.edit_note_id = note['id']
+                        st.rerun(scope="app") # The editor in the sidebar has to load the note
+                with db:
+                    if st.button("🗑️ Delete", key=f"d_{note['id']}"):
+                        try:
+                            vault.delete_note(note['id'])
+                        except ValueError as e: # PIN change in progress
+                            st.error(str(e))
+                        else:
+                            st.rerun(scope="fragment")
 
-            st.divider()
-            p_col, d_col = st.columns(2)
-            with p_col:
-                pdf_data = vl.create_pdf(note['title'], display_content)
-                pdf_bytes = bytes(pdf_data) # This converts bytearray to standard bytes
-                st.download_button("📄 Download PDF", data=pdf_bytes, file_name=f"{note['title']}.pdf", key=f"pdf_{note['id']}", use_container_width=True)
-        
-            with d_col:
-                docx_bytes = vl.create_docx(note['title'], display_content)
-                st.download_button("📝 Download DOCX", data=docx_bytes, file_name=f"{note['title']}.docx", key=f"docx_{note['id']}", use_container_width=True)
+                st.divider()
+                # Files are only built when asked for (and cached until the note changes)
+                p_col, d_col = st.columns(2)
+                if p_col.button("📄 PDF", key=f"pdf_{note['id']}", use_container_width=True):
+                    st.session_state.pending_export = (note['id'], "pdf")
+                if d_col.button("📝 DOCX", key=f"docx_{note['id']}", use_container_width=True):
+                    st.session_state.pending_export = (note['id'], "docx")
+            
+                if st.session_state.pending_export and st.session_state.pending_export[0] == note['id']:
+                    fmt = st.session_state.pending_export[1]
+                    export_bytes = st.session_state.export_cache.get(note, fmt, st.session_state.keyring)
+                    st.download_button(f"⬇️ Download {fmt.upper()}", data=export_bytes, file_name=f"{note['title']}.{fmt}", key=f"dl_{note['id']}", use_container_width=True)
+
+    if n_pages > 1:
+        grid_pager(n_pages, "bottom")
+
+notes_grid()
+
+rerun_timer.mark("grid")
+
+# --- 8. STARTUP ---
+# The grid is on screen now: record time-to-first-paint and load the AI models in the background
+vl.mark_startup("first_paint")
+vl.start_background_warmup()
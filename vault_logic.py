@@ -1,179 +1,1223 @@
 import json
 import os
 import base64
+import codecs
+import bisect
+import functools
 import hashlib
+import hmac
+import heapq
+import itertools
+import math
+import queue
+import re
 import time
+import sqlite3
+import atexit
+import contextvars
+import glob
+import gzip
+import shutil
+import tempfile
+import zipfile
+import threading
+import weakref
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from textblob import TextBlob
-from fpdf import FPDF
-from docx import Document
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 import io
-import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer
+import random
 import secrets
 import string
-from google import genai  # Gemini
 from dotenv import load_dotenv
-import nltk
-
-try:
-    nltk.data.find('tokenizers/punkt_tab')
-except LookupError:
-    nltk.download('punkt_tab')
 
 # This line reads the .env file and makes the API key available
 load_dotenv(override=True)  # 'override=True' forces it to refresh the key if you changed .env
 
-NOTES_FILE = "notes.json"
+NOTES_FILE = "notes.json"  # Legacy format, migrated into NOTES_DB on first load
+NOTES_DB = "notes.db"
 CONFIG_FILE = "vault_config.json"
+BLOBS_DIR = "blobs"  # Chunk-encrypted files of large secret notes (section 2c)
+DECRYPTION_ERROR = "[Decryption Error: Check PIN]"
+EMBED_MODEL_NAME = 'all-MiniLM-L6-v2'
+
+# --- LAZY LOADING ---
+# torch (via sentence-transformers), faiss, nltk, fpdf, python-docx and google-genai are
+# slow to import, so nothing heavy loads at import time. Each component is loaded on first
+# use, exactly once per process, and then shared by every Streamlit session.
+_PROCESS_START = time.perf_counter()
+STARTUP_TIMES = {"components": {}, "events": {}}
+_lazy_components = {}
+_lazy_locks = {}
+_lazy_locks_guard = threading.Lock()
+
+def _load_once(name, loader):
+    """Runs loader() the first time `name` is needed and caches the result process-wide"""
+    if name in _lazy_components:
+        return _lazy_components[name]
+    with _lazy_locks_guard:
+        lock = _lazy_locks.setdefault(name, threading.Lock())
+    with lock:
+        if name not in _lazy_components:
+            started = time.perf_counter()
+            _lazy_components[name] = loader()
+            STARTUP_TIMES["components"][name] = round(time.perf_counter() - started, 3)
+    return _lazy_components[name]
+
+def _load_embed_model():
+    from sentence_transformers import SentenceTransformer
+    # Load a small, fast model for embeddings (runs locally)
+    return SentenceTransformer(EMBED_MODEL_NAME)
+
+def _load_punkt():
+    import nltk
+    try:
+        nltk.data.find('tokenizers/punkt_tab')
+    except LookupError:
+        nltk.download('punkt_tab')
+    return True
+
+def get_embed_model():
+    return _load_once("embed_model", _load_embed_model)
+
+def get_faiss():
+    return _load_once("faiss", lambda: __import__("faiss"))
+
+def ensure_punkt():
+    return _load_once("punkt", _load_punkt)
+
+def __getattr__(name):
+    # Keeps `vl.embed_model` working for older callers without loading it at import time
+    if name == "embed_model":
+        return get_embed_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def mark_startup(event):
+    """Records seconds since this module was imported, the first time `event` happens"""
+    STARTUP_TIMES["events"].setdefault(event, round(time.perf_counter() - _PROCESS_START, 3))
+
+def get_startup_report():
+    """Import-to-event times plus how long each lazy component took to load"""
+    return {"events": dict(STARTUP_TIMES["events"]), "components": dict(STARTUP_TIMES["components"])}
+
+_warmup_thread = None
+
+def start_background_warmup():
+    """Loads the AI components in a daemon thread once the UI is already interactive"""
+    global _warmup_thread
+    if _warmup_thread is not None:
+        return _warmup_thread
+
+    def warm():
+        started = time.perf_counter()
+        get_faiss()
+        ensure_punkt()
+        get_embed_model()
+        STARTUP_TIMES["components"]["warmup_total"] = round(time.perf_counter() - started, 3)
+
+    _warmup_thread = threading.Thread(target=warm, name="vault-warmup", daemon=True)
+    _warmup_thread.start()
+    return _warmup_thread
+
+# --- METRICS ---
+# Counters + latency histograms for the vault_logic entry points and the phases of a
+# main.py rerun. Off by default (VAULT_METRICS=1 or enable_metrics() turns it on); when
+# off, an instrumented call costs one attribute check. Export as JSON or Prometheus text.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+class MetricsRegistry:
+    """Thread-safe counters and fixed-bucket latency histograms"""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}  # name -> {"buckets": [count per bucket], "sum": seconds, "count": n}
+
+    def inc(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        slot = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0}
+            hist["buckets"][slot] += 1
+            hist["sum"] += seconds
+            hist["count"] += 1
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return {"counters": dict(self.counters),
+                    "histograms": {k: {**h, "buckets": list(h["buckets"])} for k, h in self.histograms.items()}}
 
-# Load a small, fast model for embeddings (runs locally)
-embed_model = SentenceTransformer('all-MiniLM-L6-v2')
+    @staticmethod
+    def _quantile(hist, q):
+        # Upper bound of the bucket holding the q-th observation
+        target, seen = q * hist["count"], 0
+        for bound, count in zip(LATENCY_BUCKETS, hist["buckets"]):
+            seen += count
+            if seen >= target:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+    def summary(self):
+        """One row per timed operation: count, average and approximate p50/p95 in ms"""
+        rows = []
+        for name, hist in sorted(self.snapshot()["histograms"].items()):
+            rows.append({"name": name, "count": hist["count"],
+                         "avg_ms": round(hist["sum"] * 1000 / hist["count"], 2) if hist["count"] else 0.0,
+                         "p50_ms": self._quantile(hist, 0.5) * 1000, "p95_ms": self._quantile(hist, 0.95) * 1000})
+        return rows
+
+    def to_json(self):
+        data = self.snapshot()
+        data["bucket_bounds"] = [b if b != float("inf") else "+Inf" for b in LATENCY_BUCKETS]
+        return json.dumps(data, indent=2)
+
+    def to_prometheus(self, prefix="securevault"):
+        data = self.snapshot()
+        lines = [f"# TYPE {prefix}_events_total counter"]
+        for name, value in sorted(data["counters"].items()):
+            lines.append(f'{prefix}_events_total{{name="{name}"}} {value}')
+        lines.append(f"# TYPE {prefix}_latency_seconds histogram")
+        for name, hist in sorted(data["histograms"].items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, hist["buckets"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{prefix}_latency_seconds_bucket{{op="{name}",le="{le}"}} {cumulative}')
+            lines.append(f'{prefix}_latency_seconds_sum{{op="{name}"}} {hist["sum"]}')
+            lines.append(f'{prefix}_latency_seconds_count{{op="{name}"}} {hist["count"]}')
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry(enabled=os.getenv("VAULT_METRICS", "0") == "1")
+
+def enable_metrics(enabled=True):
+    metrics.enabled = enabled
+
+@contextmanager
+def timed(name):
+    """with timed("phase"): ... records the block's latency (no-op while metrics are off)"""
+    if not metrics.enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(name, time.perf_counter() - started)
+
+def instrument(name):
+    """Decorator version of timed() that also counts calls"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                metrics.observe(name, time.perf_counter() - started)
+                metrics.inc(f"{name}.calls")
+        return wrapper
+    return decorator
+
+class PhaseTimer:
+    """Times consecutive phases of a script: each mark() closes the phase since the last one"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        metrics.observe(f"{self.prefix}.{phase}", now - self.last)
+        self.last = now
 
 # --- 0. PIN & KEY LOGIC ---
 def get_pin_hash(pin: str):
     """Creates a secure SHA-256 hash of the PIN"""
     return hashlib.sha256(pin.encode()).hexdigest()
 
-def is_vault_initialized():
-    """Checks if a user has set a PIN yet"""
-    return os.path.exists(CONFIG_FILE)
+def is_vault_initialized(config_path=CONFIG_FILE):
+    """Checks if a user has set a PIN yet (a config reset by the recovery flow only keeps the salt)"""
+    return "pin_hash" in read_config(config_path)
 
 def generate_recovery_key():
     """Generates a random 16-character recovery string"""
     chars = string.ascii_uppercase + string.digits
     return ''.join(secrets.choice(chars) for _ in range(16))
 
-def initialize_vault(pin: str, recovery_key: str):
-    """Saves the user's initial PIN hash and recovery key hash"""
-    with open(CONFIG_FILE, "w") as f:
-        json.dump({"pin_hash": get_pin_hash(pin),
-                   "recovery_hash": get_pin_hash(recovery_key) # We hash the recovery key too!
-                   }, f)
+def read_config(config_path=CONFIG_FILE):
+    if not os.path.exists(config_path):
+        return {}
+    with open(config_path, "r") as f:
+        return json.load(f)
 
-def verify_recovery_key(input_key: str):
+def write_config(config, config_path=CONFIG_FILE):
+    """Replaces vault_config.json atomically (temp file + rename)"""
+    tmp_path = config_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(config, f)
+    os.replace(tmp_path, config_path)
+
+def initialize_vault(pin: str, recovery_key: str, config_path=CONFIG_FILE):
+    """Saves the user's initial PIN hash, recovery key hash and a random per-vault salt. A salt
+    kept by reset_vault_identity is reused, so the old PIN still opens the old secret notes."""
+    salt = read_config(config_path).get("salt") or base64.b64encode(secrets.token_bytes(SALT_BYTES)).decode()
+    write_config({"pin_hash": get_pin_hash(pin),
+                  "recovery_hash": get_pin_hash(recovery_key), # We hash the recovery key too!
+                  "salt": salt
+                  }, config_path)
+
+def reset_vault_identity(config_path=CONFIG_FILE):
+    """Forgets the PIN and recovery key hashes but keeps the salt (the legacy one written out for
+    old vaults): it is the only copy, and without it the secret notes are lost for any PIN"""
+    salt = read_config(config_path).get("salt") or base64.b64encode(LEGACY_SALT).decode()
+    write_config({"salt": salt}, config_path)
+
+def verify_recovery_key(input_key: str, config_path=CONFIG_FILE):
     """Verifies the recovery key against the stored hash"""
-    if not is_vault_initialized():
-        return False
-    with open(CONFIG_FILE, "r") as f:
-        stored_recovery_hash = json.load(f).get("recovery_hash")
-    return get_pin_hash(input_key) == stored_recovery_hash
+    stored_recovery_hash = read_config(config_path).get("recovery_hash")
+    return stored_recovery_hash is not None and get_pin_hash(input_key) == stored_recovery_hash
 
-def verify_pin(input_pin: str):
+def verify_pin(input_pin: str, config_path=CONFIG_FILE):
     """Verifies input against stored hash"""
-    if not is_vault_initialized():
-        return False
-    with open(CONFIG_FILE, "r") as f:
-        stored_hash = json.load(f).get("pin_hash")
-    return get_pin_hash(input_pin) == stored_hash
+    stored_hash = read_config(config_path).get("pin_hash")
+    return stored_hash is not None and get_pin_hash(input_pin) == stored_hash
 
 # --- 1. KEY GENERATION (From your PIN) ---
-def generate_key(pin: str):
-    """Derives a functional encryption key from the user's PIN"""
+# Vaults created before per-vault salts used this fixed salt; they keep working and are
+# moved to a random salt the next time the PIN is changed.
+LEGACY_SALT = b'stable_salt_123'
+SALT_BYTES = 16
+
+def get_vault_salt(config_path=CONFIG_FILE):
+    """The random salt stored in the config, or the legacy static salt for old vaults"""
+    salt = read_config(config_path).get("salt")
+    return base64.b64decode(salt) if salt else LEGACY_SALT
+
+def derive_key(pin: str, salt: bytes = None):
+    """Runs PBKDF2 on the PIN; returns the urlsafe-base64 key Fernet expects"""
     password = pin.encode()
-    # We use a static salt for this local project (Professional apps use random salts)
-    salt = b'stable_salt_123' 
+    if salt is None:
+        salt = get_vault_salt()
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
         length=32,
         salt=salt,
         iterations=100000,
     )
-    key = base64.urlsafe_b64encode(kdf.derive(password))
-    return Fernet(key)
+    return base64.urlsafe_b64encode(kdf.derive(password))
+
+def generate_key(pin: str, salt: bytes = None):
+    """Derives a functional encryption key from the user's PIN"""
+    return Fernet(derive_key(pin, salt))
+
+# --- 1b. PIN ROTATION ---
+# Changing the PIN re-encrypts every secret note: both keys are derived once, notes are
+# streamed from storage in id order, re-encrypted in parallel batches and committed one
+# transaction per batch. A checkpoint file records the new PIN hash and salt while the
+# rotation runs, so an interrupted rotation can be resumed (same new PIN) or rolled back. A
+# resume makes a full pass again (notes already on the new key come back "skipped"), so a note written in the
+# meantime can't be left on the old key; a Vault also refuses note writes while a rotation
+# is pending. The new PIN hash and a fresh random salt only go into the config once every
+# note has been rotated.
+ROTATION_FILE = "pin_rotation.json"
+ROTATION_BATCH = 2000
+ROTATION_WORKERS = 4
+
+def get_pending_rotation(rotation_path=ROTATION_FILE, config_path=CONFIG_FILE):
+    """The checkpoint of an unfinished PIN change, or None"""
+    if not os.path.exists(rotation_path):
+        return None
+    with open(rotation_path, "r") as f:
+        checkpoint = json.load(f)
+    config = read_config(config_path)
+    if config.get("pin_hash") == checkpoint["new_pin_hash"] and config.get("salt") == checkpoint["new_salt"]:
+        os.remove(rotation_path)  # Crashed after the config was finalized: the rotation is complete
+        return None
+    return checkpoint
+
+def _write_rotation(checkpoint, rotation_path):
+    tmp_path = rotation_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, rotation_path)
+
+def _reencrypt_token(token, from_key, to_key):
+    """Returns (new_token, status); status is "done", "skipped" (already on to_key) or "failed" """
+    try:
+        return to_key.encrypt(from_key.decrypt(token.encode())).decode(), "done"
+    except Exception:
+        try:
+            to_key.decrypt(token.encode())
+            return token, "skipped"
+        except Exception:
+            return token, "failed"
+
+def _reencrypt_blob(blob_id, from_ring, to_ring):
+    """Streams a blob file from one key to the other in place (same status values as above)"""
+    try:
+        next(from_ring.iter_blob(blob_id), None)  # Fails fast on the first chunk if it isn't ours
+    except Exception:
+        return blob_id, "skipped" if to_ring.read_blob(blob_id, max_chars=1) != DECRYPTION_ERROR else "failed"
+    try:
+        to_ring.write_blob(from_ring.iter_blob(blob_id), blob_id=blob_id)  # Temp file + rename
+        return blob_id, "done"
+    except Exception:
+        return blob_id, "failed"
+
+def _reencrypt_note(note, from_ring, to_ring):
+    if note.get('blob'):
+        return _reencrypt_blob(note['blob'], from_ring, to_ring)
+    return _reencrypt_token(note['content'], from_ring._fernet, to_ring._fernet)
+
+def _rotate_notes(storage, from_ring, to_ring, on_batch=None, batch_size=ROTATION_BATCH, workers=ROTATION_WORKERS):
+    counts = {"done": 0, "skipped": 0, "failed": 0}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for batch in storage.iter_batches(batch_size=batch_size):
+            secret = [n for n in batch if n.get('secret')]
+            results = list(pool.map(lambda n: _reencrypt_note(n, from_ring, to_ring), secret, chunksize=64))
+            changed = []
+            for note, (token, status) in zip(secret, results):
+                counts[status] += 1
+                if status == "done" and not note.get('blob'):  # Blob files were rewritten in place
+                    note['content'] = token
+                    changed.append(note)
+            storage.upsert_many(changed)  # One transaction per batch
+            if on_batch:
+                on_batch(counts)
+    return counts
+
+def _rotation_keyrings(old_pin, new_pin, checkpoint, config_path, blob_dir):
+    old_ring, new_ring = VaultKeyring(blob_dir), VaultKeyring(blob_dir)
+    old_ring.unlock(old_pin, get_vault_salt(config_path))
+    new_ring.unlock(new_pin, base64.b64decode(checkpoint["new_salt"]))
+    return old_ring, new_ring
+
+def change_pin(old_pin: str, new_pin: str, progress=None, storage=None,
+               config_path=CONFIG_FILE, rotation_path=ROTATION_FILE, blob_dir=BLOBS_DIR):
+    """Re-encrypts all secret notes from old_pin to new_pin and moves the vault to a new
+    random salt. Resumes automatically if an earlier rotation to the same PIN was interrupted.
+    progress(counts) is called after every batch. Returns the final counts."""
+    storage = storage or get_note_storage()
+    if not verify_pin(old_pin, config_path):
+        raise ValueError("Current PIN is incorrect")
+    checkpoint = get_pending_rotation(rotation_path, config_path)
+    if checkpoint and checkpoint["new_pin_hash"] != get_pin_hash(new_pin):
+        raise ValueError("Another PIN change is unfinished: resume it with the same new PIN or roll it back first")
+    if checkpoint is None:
+        checkpoint = {"new_pin_hash": get_pin_hash(new_pin),
+                      "new_salt": base64.b64encode(secrets.token_bytes(SALT_BYTES)).decode(),
+                      "started": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        _write_rotation(checkpoint, rotation_path)
+
+    old_ring, new_ring = _rotation_keyrings(old_pin, new_pin, checkpoint, config_path, blob_dir)
+
+    counts = _rotate_notes(storage, old_ring, new_ring, on_batch=progress)  # Full pass, also on resume
+    if counts["failed"]:
+        raise RuntimeError(f"{counts['failed']} secret notes could not be decrypted with the current PIN; "
+                           "nothing was finalized (resume or roll back)")
+
+    config = read_config(config_path)
+    config.update({"pin_hash": checkpoint["new_pin_hash"], "salt": checkpoint["new_salt"]})
+    write_config(config, config_path)
+    os.remove(rotation_path)
+    return counts
+
+def rollback_pin_change(old_pin: str, new_pin: str, progress=None, storage=None,
+                        config_path=CONFIG_FILE, rotation_path=ROTATION_FILE, blob_dir=BLOBS_DIR):
+    """Undoes an interrupted change_pin: every note already on the new key goes back to the old one"""
+    storage = storage or get_note_storage()
+    checkpoint = get_pending_rotation(rotation_path, config_path)
+    if checkpoint is None:
+        return None
+    if not verify_pin(old_pin, config_path) or checkpoint["new_pin_hash"] != get_pin_hash(new_pin):
+        raise ValueError("Both the current PIN and the interrupted new PIN are needed to roll back")
+    old_ring, new_ring = _rotation_keyrings(old_pin, new_pin, checkpoint, config_path, blob_dir)
+    counts = _rotate_notes(storage, new_ring, old_ring, on_batch=progress)
+    os.remove(rotation_path)
+    return counts
 
 # --- 2. ENCRYPTION / DECRYPTION ---
+@instrument("crypto.encrypt_data")
 def encrypt_data(data_string, pin):
     """Turns readable text into scrambled code"""
     f = generate_key(pin)
     return f.encrypt(data_string.encode()).decode()
 
+@instrument("crypto.decrypt_data")
 def decrypt_data(encrypted_string, pin):
     """Turns scrambled code back into readable text"""
     try:
         f = generate_key(pin)
         return f.decrypt(encrypted_string.encode()).decode()
     except Exception:
-        return "[Decryption Error: Check PIN]"
+        return DECRYPTION_ERROR
+
+# --- 2b. SESSION KEYRING ---
+# PBKDF2 is slow on purpose (100k iterations), so we derive the key ONCE at unlock
+# and keep it in memory for the session instead of re-deriving it for every note.
+class VaultKeyring:
+    """Holds the derived encryption key while the vault is unlocked"""
+
+    def __init__(self, blob_dir=None):
+        self._fernet = None
+        self._mac_key = None
+        self._blob_cipher = None
+        self.salt = None  # Salt the key was derived with: tells a key from before a PIN change
+        self.blob_dir = blob_dir or BLOBS_DIR  # Where this vault keeps large secret payloads
+
+    @property
+    def is_unlocked(self):
+        return self._fernet is not None
+
+    def unlock(self, pin: str, salt: bytes = None):
+        """Derives the key from the PIN (runs PBKDF2 exactly once)"""
+        salt = salt if salt is not None else get_vault_salt()
+        key = derive_key(pin, salt)
+        self.salt = salt
+        self._fernet = Fernet(key)
+        self._mac_key = hashlib.sha256(b"vault-mac:" + key).digest() # Separate key for fingerprints
+        self._blob_cipher = AESGCM(hashlib.sha256(b"vault-blob:" + key).digest()) # ...and for blobs
+
+    def copy(self):
+        """A second handle on the same key: locking one of them leaves the other unlocked"""
+        other = VaultKeyring(self.blob_dir)
+        other._fernet, other._mac_key, other._blob_cipher, other.salt = self._fernet, self._mac_key, self._blob_cipher, self.salt
+        return other
+
+    def lock(self):
+        """Wipes the key from memory (auto-lock / Close Vault)"""
+        self._fernet = None
+        self._mac_key = None
+        self._blob_cipher = None
+        self.salt = None
+
+    def fingerprint(self, data_string):
+        """Keyed hash (HMAC-SHA256) of secret text: comparable for dedup, useless without the PIN"""
+        if self._mac_key is None:
+            raise RuntimeError("Vault is locked")
+        return hmac.new(self._mac_key, data_string.encode(), hashlib.sha256).hexdigest()
+
+    def encrypt(self, data_string):
+        if self._fernet is None:
+            raise RuntimeError("Vault is locked")
+        return self._fernet.encrypt(data_string.encode()).decode()
+
+    def decrypt(self, encrypted_string):
+        if self._fernet is None:
+            return DECRYPTION_ERROR
+        try:
+            return self._fernet.decrypt(encrypted_string.encode()).decode()
+        except Exception:
+            return DECRYPTION_ERROR
+
+    @instrument("crypto.encrypt_many")
+    def encrypt_many(self, data_strings):
+        """Encrypts a list of strings with the already-derived key"""
+        return [self.encrypt(s) for s in data_strings]
+
+    @instrument("crypto.decrypt_many")
+    def decrypt_many(self, encrypted_strings):
+        """Decrypts a list of strings with the already-derived key"""
+        return [self.decrypt(s) for s in encrypted_strings]
+
+    @instrument("crypto.write_blob")
+    def write_blob(self, text, blob_id=None):
+        """Encrypts text (a string, or an iterable of string pieces) into a blob file; returns its id"""
+        if self._blob_cipher is None:
+            raise RuntimeError("Vault is locked")
+        blob_id = blob_id or secrets.token_hex(16)
+        pieces = _text_chunks(text) if isinstance(text, str) else text
+        write_blob_file(blob_path(self.blob_dir, blob_id), (p.encode() for p in pieces), self._blob_cipher)
+        return blob_id
+
+    def iter_blob(self, blob_id):
+        """Yields the blob's text chunk by chunk; raises on a wrong key or a tampered file"""
+        if self._blob_cipher is None:
+            raise RuntimeError("Vault is locked")
+        decoder = codecs.getincrementaldecoder("utf-8")()  # A character may straddle two chunks
+        for plain in iter_blob_file(blob_path(self.blob_dir, blob_id), self._blob_cipher):
+            text = decoder.decode(plain)
+            if text:
+                yield text
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            yield tail
+
+    def read_blob(self, blob_id, max_chars=None):
+        """The blob's text, or just its first max_chars (only those chunks get decrypted)"""
+        parts, count = [], 0
+        try:
+            for text in self.iter_blob(blob_id):
+                parts.append(text)
+                count += len(text)
+                if max_chars is not None and count >= max_chars:
+                    break
+        except Exception:
+            return DECRYPTION_ERROR
+        text = "".join(parts)
+        return text if max_chars is None else text[:max_chars]
+
+# --- 2c. LARGE SECRET PAYLOADS (BLOBS) ---
+# Fernet encrypts a whole string at once and base64-encodes it, so a big secret note costs
+# several full copies in memory and bloats every row read. Secret text above
+# BLOB_THRESHOLD_CHARS is written instead to its own file as a chunked AES-GCM stream:
+#   header = MAGIC + 7-byte random prefix
+#   record = 4-byte length + AES-GCM(chunk), nonce = prefix + 4-byte counter + final flag,
+#            with the header as associated data.
+# Every chunk is authenticated on its own and the final flag in the nonce makes a truncated
+# or extended file fail to decrypt (the STREAM construction), so reading the first chunk is
+# enough for a preview and memory is bounded by the chunk size, not the note size.
+BLOB_THRESHOLD_CHARS = 32 * 1024
+BLOB_CHUNK_CHARS = 16 * 1024   # At most 64 KB of UTF-8 per chunk
+BLOB_MAGIC = b"VBLOB1"
+PREVIEW_CHARS = 200
+
+def blob_path(blob_dir, blob_id):
+    return os.path.join(blob_dir, f"{blob_id}.bin")
+
+def _text_chunks(text, size=BLOB_CHUNK_CHARS):
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+def _blob_nonce(prefix, counter, final):
+    return prefix + counter.to_bytes(4, "big") + (b"\x01" if final else b"\x00")
+
+def write_blob_file(path, chunks, cipher):
+    """Encrypts an iterable of byte chunks into path (temp file + rename, so never half-written)"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    header = BLOB_MAGIC + secrets.token_bytes(7)
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            counter, pending = 0, None
+            for chunk in chunks:
+                if pending is not None:  # One chunk of lookahead tells us which one is final
+                    sealed = cipher.encrypt(_blob_nonce(header[-7:], counter, False), pending, header)
+                    f.write(len(sealed).to_bytes(4, "big") + sealed)
+                    counter += 1
+                pending = chunk
+            sealed = cipher.encrypt(_blob_nonce(header[-7:], counter, True), pending or b"", header)
+            f.write(len(sealed).to_bytes(4, "big") + sealed)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def iter_blob_file(path, cipher):
+    """Yields decrypted byte chunks; raises ValueError/InvalidTag on a bad key or damaged file"""
+    with open(path, "rb") as f:
+        header = f.read(len(BLOB_MAGIC) + 7)
+        if not header.startswith(BLOB_MAGIC):
+            raise ValueError(f"{path} is not a vault blob")
+        counter = 0
+        size = f.read(4)
+        while size:
+            sealed = f.read(int.from_bytes(size, "big"))
+            size = f.read(4)  # Lookahead: no next record means this one must be the final chunk
+            yield cipher.decrypt(_blob_nonce(header[-7:], counter, not size), sealed, header)
+            counter += 1
+
+def delete_blob(blob_dir, blob_id):
+    path = blob_path(blob_dir, blob_id)
+    if os.path.exists(path):
+        os.remove(path)
+
+def set_note_content(note, text, secret, keyring=None):
+    """Stores text in the note: plain, as an inline Fernet token, or as a blob file when
+    it's a large secret. Any blob the note pointed to before is for the caller to delete."""
+    if text == DECRYPTION_ERROR:
+        raise ValueError("This note couldn't be decrypted; saving it would overwrite its content")
+    note.pop('blob', None)
+    note['secret'] = secret
+    if not secret:
+        note['content'] = text
+    elif len(text) >= BLOB_THRESHOLD_CHARS:
+        note['blob'] = keyring.write_blob(text)
+        note['content'] = ""
+    else:
+        note['content'] = keyring.encrypt(text)
+    return note
+
+def note_hash(note):
+    """content_hash of what's stored for the note (a new blob id means new content)"""
+    return content_hash(note['content'] + note.get('blob', ""))
+
+def get_note_text(note, keyring=None):
+    """Returns the readable content of a note (decrypted if secret and unlocked)"""
+    if note.get('secret') and keyring is not None and keyring.is_unlocked:
+        if note.get('blob'):
+            return keyring.read_blob(note['blob'])
+        return keyring.decrypt(note['content'])
+    return note['content']
+
+def get_notes_text(notes, keyring=None):
+    """Bulk version of get_note_text: decrypts all secret notes in one pass"""
+    texts = [n['content'] for n in notes]
+    if keyring is None or not keyring.is_unlocked:
+        return texts
+    secret_idx = [i for i, n in enumerate(notes) if n.get('secret') and not n.get('blob')]
+    decrypted = keyring.decrypt_many([texts[i] for i in secret_idx])
+    for i, text in zip(secret_idx, decrypted):
+        texts[i] = text
+    for i, note in enumerate(notes):
+        if note.get('secret') and note.get('blob'):
+            texts[i] = keyring.read_blob(note['blob'])
+    return texts
+
+def get_note_preview(note, keyring=None, chars=PREVIEW_CHARS):
+    """The first chars characters for the grid ("..." if there's more); a blob only has its
+    first chunk decrypted"""
+    if note.get('secret') and note.get('blob') and keyring is not None and keyring.is_unlocked:
+        text = keyring.read_blob(note['blob'], max_chars=chars + 1)
+    else:
+        text = get_note_text(note, keyring)
+    return text[:chars] + "..." if len(text) > chars else text
+
+def get_notes_preview(notes, keyring=None, chars=PREVIEW_CHARS):
+    """Bulk previews: inline secrets are decrypted in one pass, blobs only up to chars"""
+    inline = [n for n in notes if not n.get('blob')]
+    texts = dict(zip((n['id'] for n in inline), get_notes_text(inline, keyring)))
+    previews = []
+    for note in notes:
+        if note['id'] in texts:
+            text = texts[note['id']]
+            previews.append(text[:chars] + "..." if len(text) > chars else text)
+        else:
+            previews.append(get_note_preview(note, keyring, chars))
+    return previews
 
 # --- 3. UPDATED LOAD/SAVE ---
+# Notes live in SQLite: every save is a small atomic transaction instead of rewriting
+# the whole JSON file, so one edit costs the same on a 10-note or a 50k-note vault.
+# An old notes.json is imported once and then renamed to notes.json.migrated.
+class NoteStorage:
+    """SQLite-backed note storage with per-note upsert/delete"""
+
+    def __init__(self, path=NOTES_DB, legacy_file=NOTES_FILE):
+        self.path = path
+        self.legacy_file = legacy_file
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS notes (id INTEGER PRIMARY KEY, seq INTEGER NOT NULL, data TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS notes_seq ON notes (seq)")
+        # Sources already brought in by bulk_import.py, so an interrupted import can resume
+        self._conn.execute("CREATE TABLE IF NOT EXISTS imports (source TEXT PRIMARY KEY, note_id INTEGER)")
+        self._conn.commit()
+        self._migrate_legacy()
+
+    def _migrate_legacy(self):
+        """One-time import of the old notes.json (newest note first, like the UI list)"""
+        if not self.legacy_file or not os.path.exists(self.legacy_file):
+            return
+        if self._conn.execute("SELECT 1 FROM notes LIMIT 1").fetchone():
+            return
+        with open(self.legacy_file, "r") as f:
+            legacy_notes = json.load(f)
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO notes (id, seq, data) VALUES (?, ?, ?)",
+                                   [(n['id'], len(legacy_notes) - i, json.dumps(n)) for i, n in enumerate(legacy_notes)])
+        os.replace(self.legacy_file, self.legacy_file + ".migrated")
+
+    def load(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM notes ORDER BY seq DESC").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def iter_batches(self, after_id=None, batch_size=1000):
+        """Yields notes in id order, batch_size at a time, without loading the whole vault"""
+        last_id = after_id
+        while True:
+            with self._lock:
+                if last_id is None:
+                    rows = self._conn.execute("SELECT id, data FROM notes ORDER BY id LIMIT ?", (batch_size,)).fetchall()
+                else:
+                    rows = self._conn.execute("SELECT id, data FROM notes WHERE id > ? ORDER BY id LIMIT ?",
+                                              (last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield [json.loads(row[1]) for row in rows]
+
+    def upsert_many(self, notes_list):
+        """Inserts new notes on top of the list, updates existing ones in place"""
+        with self._lock, self._conn:
+            for note in notes_list:
+                self._conn.execute(
+                    "INSERT INTO notes (id, seq, data) VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM notes), ?) "
+                    "ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+                    (note['id'], json.dumps(note)))
+
+    def upsert(self, note):
+        self.upsert_many([note])
+
+    def data_version(self):
+        """Changes whenever ANOTHER connection (e.g. bulk_import.py) commits to the database"""
+        with self._lock:
+            return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _add_notes(self, notes_list):
+        """Gives each note a fresh id and inserts it on top of the list. Must run inside a
+        write transaction: ids come from MAX(id) under SQLite's write lock, and a plain
+        INSERT means a collision with another writer fails loudly instead of replacing."""
+        first_id, seq = self._conn.execute("SELECT COALESCE(MAX(id), 0) + 1, COALESCE(MAX(seq), 0) FROM notes").fetchone()
+        first_id = max(first_id, int(datetime.now().timestamp()))  # Ids stay creation timestamps where they can
+        for i, note in enumerate(notes_list):
+            note['id'] = first_id + i
+        self._conn.executemany("INSERT INTO notes (id, seq, data) VALUES (?, ?, ?)",
+                               [(n['id'], seq + i + 1, json.dumps(n)) for i, n in enumerate(notes_list)])
+
+    def insert(self, note):
+        """Adds a new note, setting its id"""
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")  # Take the write lock before reading MAX(id)
+            self._add_notes([note])
+        return note['id']
+
+    def imported_sources(self, sources):
+        """The subset of sources that an earlier import already committed"""
+        found = set()
+        sources = list(sources)
+        with self._lock:
+            for start in range(0, len(sources), 500):  # Stay under SQLite's variable limit
+                part = sources[start:start + 500]
+                rows = self._conn.execute(f"SELECT source FROM imports WHERE source IN ({','.join('?' * len(part))})", part)
+                found.update(row[0] for row in rows)
+        return found
+
+    def import_batch(self, notes_list, sources):
+        """Adds imported notes (ids are assigned here) and records every processed source in
+        ONE transaction, so a crash never leaves half a batch behind. sources is a list of
+        (source, note) with note None for duplicates and unreadable files."""
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._add_notes(notes_list)
+            self._conn.executemany("INSERT OR REPLACE INTO imports (source, note_id) VALUES (?, ?)",
+                                   [(source, note['id'] if note is not None else None) for source, note in sources])
+
+    def delete(self, note_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM notes WHERE id = ?", (note_id,))
+
+    def replace_all(self, notes_list):
+        """Replaces the whole vault in a single transaction (kept for save_notes)"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM notes")
+            self._conn.executemany("INSERT OR REPLACE INTO notes (id, seq, data) VALUES (?, ?, ?)",
+                                   [(n['id'], len(notes_list) - i, json.dumps(n)) for i, n in enumerate(notes_list)])
+
+_note_storage = None
+
+def get_note_storage():
+    """Opens the default storage on first use (this also runs the JSON migration)"""
+    global _note_storage
+    if _note_storage is None:
+        _note_storage = NoteStorage()
+    return _note_storage
+
+@instrument("storage.load_notes")
 def load_notes():
-    if os.path.exists(NOTES_FILE):
-        with open(NOTES_FILE, "r") as f:
-            return json.load(f)
-    return []
+    return get_note_storage().load()
 
+@instrument("storage.save_notes")
 def save_notes(notes_list):
-    with open(NOTES_FILE, "w") as f:
-        json.dump(notes_list, f, indent=4)
+    get_note_storage().replace_all(notes_list)
+
+@instrument("storage.save_note")
+def save_note(note):
+    """Saves one new or edited note (constant time, atomic)"""
+    get_note_storage().upsert(note)
+
+@instrument("storage.delete_note")
+def delete_note(note_id):
+    """Deletes one note (constant time, atomic)"""
+    get_note_storage().delete(note_id)
 
 def get_page_heading(is_unlocked):
     return "🛡️ Safe Vault" if is_unlocked else "📝 My Notes"
 
-def get_filtered_notes(all_notes, is_unlocked, search_query):
+@instrument("search.get_filtered_notes")
+def get_filtered_notes(all_notes, is_unlocked, search_query, search_index=None, limit=None):
+    """Visible notes matching the query; with a search index, the best `limit` matches, ranked"""
+    if search_index is not None and search_query.strip():
+        return search_index.search(search_query, include_secret=is_unlocked, limit=limit)
+
     visible = all_notes
     if not is_unlocked:
         visible = [n for n in all_notes if not n.get('secret', False)]
-    
+
     query = search_query.lower()
     return [n for n in visible if query in n['title'].lower() or query in n['content'].lower()]
 
+# The grid shows one page at a time, so a rerun only decrypts and renders that page.
+# Filtered lists are memoized per (notes version, lock state, query): a click that doesn't
+# change the notes or the search box costs a dict lookup instead of a scan of the vault.
+NOTES_PAGE_SIZE = 12
+NOTE_LIST_MEMO_ENTRIES = 8
+
+def paginate(items, page, page_size=NOTES_PAGE_SIZE):
+    """Returns (items on the page, clamped page number, page count); pages start at 1"""
+    n_pages = max(1, math.ceil(len(items) / page_size))
+    page = min(max(1, page), n_pages)
+    start = (page - 1) * page_size
+    return items[start:start + page_size], page, n_pages
+
+class NoteListMemo:
+    """Small LRU of get_filtered_notes results for one session"""
+
+    def __init__(self, max_entries=NOTE_LIST_MEMO_ENTRIES):
+        self.max_entries = max_entries
+        self.lists = OrderedDict()
+
+    def filtered(self, all_notes, version, is_unlocked, search_query, search_index=None, limit=None):
+        """get_filtered_notes, recomputed only when version (bumped on every note change),
+        the lock state, the query, the search index or the limit changed"""
+        key = (version, is_unlocked, search_query, id(search_index), limit)
+        if key in self.lists:
+            self.lists.move_to_end(key)
+            return self.lists[key]
+        result = get_filtered_notes(all_notes, is_unlocked, search_query, search_index, limit)
+        self.lists[key] = result
+        while len(self.lists) > self.max_entries:
+            self.lists.popitem(last=False)
+        return result
+
+    def clear(self):
+        self.lists.clear()
+
+# --- 3b. FULL-TEXT SEARCH INDEX ---
+# An in-memory inverted index (word -> {note_id: weight}) plus a sorted word list for
+# prefix lookups, so a keystroke only touches the postings of matching words instead of
+# scanning every note. A prefix expands to all of its matching words; the most selective
+# query word seeds at most SEARCH_MAX_CANDIDATES candidates (SEARCH_MAX_NARROWED if other
+# words have to be checked against them), exact and rare words first since they score
+# highest. The other words only narrow the candidates down, and only the top `limit`
+# results are ranked. The results say when the seed was cut short. Secret notes are
+# indexed from their DECRYPTED text, which means the index must live only in memory and be
+# thrown away when the last unlocked session locks.
+SEARCH_TITLE_WEIGHT = 3.0
+SEARCH_POSTING_BYTES = 150  # Rough memory per (word, note) pair, for the tenant memory budget
+SEARCH_WORD_BYTES = 120
+SEARCH_RESULT_LIMIT = 500   # Matches the grid ranks and pages through; the rest are never sorted
+# Notes the most selective query word may seed: scoring one is cheap, checking it against
+# further words is not. Keeps a keystroke around 10 ms at 50k notes
+SEARCH_MAX_CANDIDATES = 5000
+SEARCH_MAX_NARROWED = 1000
+
+class SearchResults(list):
+    """Ranked notes, plus how many notes matched in all and whether a very broad query was
+    cut short (then some matches are missing, not just unranked)"""
+
+    def __init__(self, notes=(), total=0, truncated=False):
+        super().__init__(notes)
+        self.total = total
+        self.truncated = truncated
+
+_MAX_CHAR = chr(0x10FFFF)   # Sorts after any character that can follow a prefix
+_WORD_RE = re.compile(r"\w+")
+
+def tokenize(text):
+    return _WORD_RE.findall(text.lower())
+
+class SearchIndex:
+    """Ranked, prefix-matching inverted index over note titles + content"""
+
+    def __init__(self, notes=(), keyring=None):
+        self.keyring = keyring
+        self.postings = {}   # word -> {note_id: weight}
+        self.note_words = {} # note_id -> set of words (needed to remove a note quickly)
+        self.notes = {}      # note_id -> note dict
+        self.vocab = []      # sorted list of words for bisect prefix search
+        self.n_postings = 0  # (word, note) pairs, for memory_bytes()
+        self._lock = threading.RLock()  # A vault's sessions share one index
+        for note in notes:
+            self.upsert(note)
+
+    def upsert(self, note):
+        """Adds or re-indexes one note (call after save)"""
+        with self._lock:
+            self.remove(note['id'])
+            if note.get('secret') and (self.keyring is None or not self.keyring.is_unlocked):
+                return  # Locked: secret notes are neither searchable nor visible
+            weights = Counter(tokenize(get_note_text(note, self.keyring)))
+            for word in tokenize(note['title']):
+                weights[word] += SEARCH_TITLE_WEIGHT
+            for word, weight in weights.items():
+                posting = self.postings.get(word)
+                if posting is None:
+                    posting = self.postings[word] = {}
+                    bisect.insort(self.vocab, word)
+                posting[note['id']] = weight
+            self.note_words[note['id']] = set(weights)
+            self.notes[note['id']] = note
+            self.n_postings += len(weights)
+
+    def remove(self, note_id):
+        """Drops one note from the index (call after delete)"""
+        with self._lock:
+            words = self.note_words.pop(note_id, ())
+            self.n_postings -= len(words)
+            for word in words:
+                posting = self.postings[word]
+                posting.pop(note_id, None)
+                if not posting:
+                    del self.postings[word]
+                    del self.vocab[bisect.bisect_left(self.vocab, word)]
+            self.notes.pop(note_id, None)
+
+    def memory_bytes(self):
+        """Rough resident size: postings dominate (a dict entry plus a set entry each)"""
+        return self.n_postings * SEARCH_POSTING_BYTES + len(self.vocab) * SEARCH_WORD_BYTES
+
+    def _expand(self, term, prefix):
+        """[(word, posting, boost)] for the term, highest boost first; rare words count more
+        (idf), exact beats prefix"""
+        total = len(self.notes) or 1
+        if not prefix:
+            posting = self.postings.get(term)
+            return [(term, posting, math.log(1 + total / len(posting)))] if posting else []
+        lo = bisect.bisect_left(self.vocab, term)
+        expansions = []
+        for word in self.vocab[lo:bisect.bisect_left(self.vocab, term + _MAX_CHAR, lo)]:
+            posting = self.postings[word]
+            expansions.append((word, posting, math.log(1 + total / len(posting)) * (1.0 if word == term else 0.5)))
+        expansions.sort(key=lambda exp: -exp[2])
+        return expansions
+
+    def search(self, query, include_secret=True, limit=None):
+        """SearchResults: notes matching every query word, best match first.
+        Finished words must match exactly; the word still being typed matches as a prefix."""
+        with self._lock:
+            words = tokenize(query)
+            if not words:
+                return SearchResults()
+            last_is_prefix = not query[-1].isspace()
+            terms = [self._expand(w, last_is_prefix and i == len(words) - 1) for i, w in enumerate(words)]
+            truncated = False
+            max_candidates = SEARCH_MAX_CANDIDATES if len(terms) == 1 else SEARCH_MAX_NARROWED
+            # Start from the most selective term so later terms only check a few candidates
+            terms.sort(key=lambda exp: sum(len(p) for _, p, _ in exp))
+            avg_words = self.n_postings / max(1, len(self.note_words))
+            scores = None
+            for expansions in terms:
+                postings_cost = sum(len(p) for _, p, _ in expansions)
+                if scores is None:
+                    # A very common word or short prefix would put most of the vault up for
+                    # ranking: stop seeding at max_candidates, best-scoring words first
+                    scores = {}
+                    for _, posting, boost in expansions:
+                        room = max_candidates - len(scores)
+                        if room <= 0:
+                            truncated = True
+                            break
+                        items = posting.items()
+                        if len(posting) > room:
+                            items, truncated = itertools.islice(items, room), True
+                        for note_id, weight in items:
+                            scores[note_id] = scores.get(note_id, 0.0) + weight * boost
+                elif len(scores) * min(len(expansions), avg_words) < postings_cost:
+                    # Few candidates: check each candidate against the term directly
+                    boosts = {word: (posting, boost) for word, posting, boost in expansions}
+                    wanted = set(boosts)
+                    narrowed = {}
+                    for note_id, score in scores.items():
+                        extra = 0.0
+                        if len(expansions) <= avg_words:
+                            for _, posting, boost in expansions:
+                                weight = posting.get(note_id)
+                                if weight:
+                                    extra += weight * boost
+                        else:
+                            for word in self.note_words[note_id] & wanted:  # Set intersection runs in C
+                                posting, boost = boosts[word]
+                                extra += posting[note_id] * boost
+                        if extra:
+                            narrowed[note_id] = score + extra
+                    scores = narrowed
+                else:
+                    # Many candidates: walk the postings and keep only candidates
+                    extra = {}
+                    for _, posting, boost in expansions:
+                        for note_id, weight in posting.items():
+                            if note_id in scores:
+                                extra[note_id] = extra.get(note_id, 0.0) + weight * boost
+                    scores = {note_id: scores[note_id] + e for note_id, e in extra.items()}
+                if not scores:
+                    return SearchResults(truncated=truncated)
+            if not include_secret:
+                scores = {i: sc for i, sc in scores.items() if not self.notes[i].get('secret')}
+            ranked = heapq.nlargest(limit, scores, key=scores.get) if limit else sorted(scores, key=scores.get, reverse=True)
+            return SearchResults([self.notes[i] for i in ranked], len(scores), truncated)
+
 # --- 4. AI FEATURES ---
-def ai_summarize_text(text):
+# Extractive: sentences are embedded with the same MiniLM model as the RAG search and
+# ranked by similarity to the note's centroid, with a penalty for repeating an already
+# picked sentence. The picks are returned in their original order. Summaries are cached by
+# content hash, so clicking "AI Summarize" again on the same text does no work at all.
+SUMMARY_SENTENCES = int(os.getenv("VAULT_SUMMARY_SENTENCES", "3"))
+SUMMARY_MIN_CHARS = 50        # Shorter notes are returned as they are
+SUMMARY_REDUNDANCY = 0.5      # How strongly similarity to picked sentences counts against a candidate
+SUMMARY_CACHE_MAX_ENTRIES = 256
+
+def split_sentences(text):
+    from nltk.tokenize import sent_tokenize
+    ensure_punkt()
+    return [s.strip() for s in sent_tokenize(text) if s.strip()]
+
+def rank_sentences(vectors, max_sentences):
+    """Indexes of the picked sentences (centroid relevance minus redundancy), in text order"""
+    centroid = vectors.mean(axis=0)
+    relevance = vectors @ centroid
+    picked = []
+    while len(picked) < min(max_sentences, len(vectors)):
+        scores = relevance.copy()
+        if picked:
+            scores -= SUMMARY_REDUNDANCY * (vectors @ vectors[picked].T).max(axis=1)
+            scores[picked] = -np.inf
+        picked.append(int(np.argmax(scores)))
+    return sorted(picked)
+
+def _format_summary(sentences):
+    return "AI Summary:\n" + "\n".join(f"- {s}" for s in sentences)
+
+class SummaryCache:
+    """Small LRU of summaries for one session, keyed by text hash and summary length"""
+
+    def __init__(self, max_entries=SUMMARY_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.summaries = OrderedDict()
+
+    def get(self, key):
+        if key in self.summaries:
+            self.summaries.move_to_end(key)
+            return self.summaries[key]
+        return None
+
+    def put(self, key, summary):
+        self.summaries[key] = summary
+        while len(self.summaries) > self.max_entries:
+            self.summaries.popitem(last=False)
+
+    def clear(self):
+        self.summaries.clear()
+
+@instrument("ai.summarize_many")
+def ai_summarize_many(texts, max_sentences=SUMMARY_SENTENCES, cache=None):
+    """Summarizes many texts with a single embedding pass over all their sentences.
+    Usage is recorded only for texts that were actually summarized (not cache hits)."""
+    results = [None] * len(texts)
+    pending = []  # (position, cache key, sentences)
+    duplicates = {}  # Same text twice in one batch: summarized once
+    first_seen = {}
+    for i, text in enumerate(texts):
+        if len(text) < SUMMARY_MIN_CHARS:
+            results[i] = text  # Don't summarize very short notes
+            continue
+        key = (content_hash(text), max_sentences)
+        if key in first_seen:
+            duplicates[i] = first_seen[key]
+            continue
+        first_seen[key] = i
+        cached = cache.get(key) if cache is not None else None
+        if cached is not None:
+            results[i] = cached
+            continue
+        sentences = split_sentences(text)
+        if len(sentences) <= max_sentences:
+            results[i] = text  # Already as short as the summary would be
+            continue
+        pending.append((i, key, sentences))
+
+    if pending:
+        vectors = embed_texts([s for _, _, sentences in pending for s in sentences])
+        offset = 0
+        for i, key, sentences in pending:
+            picked = rank_sentences(vectors[offset:offset + len(sentences)], max_sentences)
+            offset += len(sentences)
+            summary = _format_summary([sentences[j] for j in picked])
+            track_usage(texts[i], type="input", model=EMBED_MODEL_NAME, operation="summarize")
+            track_usage(summary, type="output", model=EMBED_MODEL_NAME, operation="summarize")
+            results[i] = summary
+            if cache is not None:
+                cache.put(key, summary)
+
+    for i, source in duplicates.items():
+        results[i] = results[source]
+    return results
+
+@instrument("ai.summarize")
+def ai_summarize_text(text, max_sentences=SUMMARY_SENTENCES, cache=None):
     """Uses NLP to extract key points from long notes."""
-    if len(text) < 50:
-        return text # Don't summarize very short notes
-    
-    blob = TextBlob(text)
-    # Extracting sentences and picking the top 2 for a summary
-    sentences = [str(s) for s in blob.sentences]
-    
-    if len(sentences) > 2:
-        summary = "AI Summary:\n" + "\n".join([f"- {s}" for s in sentences[:2]])
-        
-        # NEW: Log the usage here!
-        track_usage(text, type="input") 
-        track_usage(summary, type="output")
-        return summary
-    return text
+    return ai_summarize_many([text], max_sentences, cache)[0]
 
 # --- 5. EXPORTS ---
 # The Logic Functions : These handle the actual file creation.
+def _pdf_add_note(pdf, title, content):
+    # 1. THE CLEANER: This removes long dashes, emojis, and special bullets
+    # It replaces them with nothing or a standard space so the PDF doesn't crash
+    clean_title = title.encode("ascii", "ignore").decode("ascii")
+    clean_content = content.encode("ascii", "ignore").decode("ascii")
+
+    pdf.add_page()
+    
+    # 2. Use 'Arial' (the most stable font for Linux servers)
+    pdf.set_font("Arial", "B", 16)
+    pdf.multi_cell(0, 10, clean_title)
+    pdf.ln(5)
+    
+    pdf.set_font("Arial", size=12)
+    pdf.multi_cell(0, 10, clean_content)
+
+def _pdf_bytes(pdf):
+    # 3. Stream output as a string first
+    pdf_str = pdf.output(dest='S')
+    
+    # 4. Convert to BYTES (Streamlit buttons on HF MUST have bytes)
+    if isinstance(pdf_str, str):
+        return pdf_str.encode('latin-1')
+    return bytes(pdf_str)
+
+@instrument("export.create_pdf")
 def create_pdf(title, content):
     try:
-        # 1. THE CLEANER: This removes long dashes, emojis, and special bullets
-        # It replaces them with nothing or a standard space so the PDF doesn't crash
-        clean_title = title.encode("ascii", "ignore").decode("ascii")
-        clean_content = content.encode("ascii", "ignore").decode("ascii")
-
+        from fpdf import FPDF
         pdf = FPDF()
-        pdf.add_page()
-        
-        # 2. Use 'Arial' (the most stable font for Linux servers)
-        pdf.set_font("Arial", "B", 16)
-        pdf.multi_cell(0, 10, clean_title)
-        pdf.ln(5)
-        
-        pdf.set_font("Arial", size=12)
-        pdf.multi_cell(0, 10, clean_content)
-        
-        # 3. Stream output as a string first
-        pdf_str = pdf.output(dest='S')
-        
-        # 4. Convert to BYTES (Streamlit buttons on HF MUST have bytes)
-        if isinstance(pdf_str, str):
-            return pdf_str.encode('latin-1')
-        return pdf_str
+        _pdf_add_note(pdf, title, content)
+        return _pdf_bytes(pdf)
 
     except Exception as e:
         # If there is still an error, this will show the message instead of crashing
         return f"ERROR: {str(e)}".encode('utf-8')
         
+@instrument("export.create_docx")
 def create_docx(title, content):
+    from docx import Document
     doc = Document()
     doc.add_heading(title, 0)
     doc.add_paragraph(content)
@@ -181,108 +1225,1764 @@ def create_docx(title, content):
     doc.save(bio)
     return bio.getvalue()
 
+# --- 5b. ON-DEMAND EXPORT CACHE ---
+# Files are only built when the user asks for them, and kept per session keyed by
+# (note id, content hash, format) so a second download of an unchanged note is free.
+# The cache can hold decrypted secret content, so the UI clears it on lock.
+EXPORT_CACHE_MAX_ENTRIES = 32
+EXPORT_BUILDERS = {"pdf": create_pdf, "docx": create_docx}
+
+class ExportCache:
+    """Small LRU cache of generated PDF/DOCX files for one session"""
+
+    def __init__(self, max_entries=EXPORT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.files = OrderedDict()
+
+    def get(self, note, fmt, keyring=None):
+        """Returns the export bytes, decrypting and building them only on a cache miss"""
+        key = (note['id'], note_hash(note), fmt)
+        if key in self.files:
+            self.files.move_to_end(key)
+            return self.files[key]
+        data = EXPORT_BUILDERS[fmt](note['title'], get_note_text(note, keyring))
+        self.files[key] = data
+        while len(self.files) > self.max_entries:
+            self.files.popitem(last=False)
+        return data
+
+    def clear(self):
+        self.files.clear()
+
+# --- 5c. EXPORT ALL ---
+# Notes are decrypted and written one at a time into a spooled temp file, so a ZIP export
+# never holds more than one note in memory. For the combined PDF/DOCX the document object
+# still grows with the vault (fpdf/python-docx keep pages in memory), but no full list of
+# decrypted notes is ever built.
+EXPORT_SPOOL_BYTES = 8 * 1024 * 1024
+
+def iter_notes_text(notes, keyring=None):
+    """Yields (note, readable text) one note at a time"""
+    for note in notes:
+        yield note, get_note_text(note, keyring)
+
+def _safe_filename(title, fallback):
+    cleaned = "".join(c for c in title if c.isalnum() or c in " -_").strip()
+    return cleaned[:60] or fallback
+
+@instrument("export.vault_zip")
+def export_vault_zip(notes, keyring=None, fmt="txt", fileobj=None):
+    """Streams every note into a ZIP (one .txt/.pdf/.docx per note); returns the file rewound"""
+    fileobj = fileobj or tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    with zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for idx, (note, text) in enumerate(iter_notes_text(notes, keyring)):
+            name = f"{idx + 1:05d}_{_safe_filename(note['title'], 'note')}.{fmt}"
+            if fmt == "txt":
+                zf.writestr(name, f"{note['title']}\n{note['timestamp']}\n\n{text}")
+            else:
+                zf.writestr(name, EXPORT_BUILDERS[fmt](note['title'], text))
+    fileobj.seek(0)
+    return fileobj
+
+@instrument("export.vault_pdf")
+def export_vault_pdf(notes, keyring=None, fileobj=None):
+    """Builds one combined PDF, adding notes page by page"""
+    from fpdf import FPDF
+    fileobj = fileobj or tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    pdf = FPDF()
+    for note, text in iter_notes_text(notes, keyring):
+        _pdf_add_note(pdf, note['title'], text)
+    fileobj.write(_pdf_bytes(pdf))
+    fileobj.seek(0)
+    return fileobj
+
+@instrument("export.vault_docx")
+def export_vault_docx(notes, keyring=None, fileobj=None):
+    """Builds one combined DOCX with a heading + page break per note"""
+    from docx import Document
+    fileobj = fileobj or tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    doc = Document()
+    for idx, (note, text) in enumerate(iter_notes_text(notes, keyring)):
+        if idx:
+            doc.add_page_break()
+        doc.add_heading(note['title'], 1)
+        doc.add_paragraph(text)
+    doc.save(fileobj)
+    fileobj.seek(0)
+    return fileobj
+
 # --- 6. AI & RESOURCE TRACKER ---
-def track_usage(text, type="input"):
+# Counting happens in memory (thread-safe, shared by all sessions in this process) and a
+# background thread flushes to usage_stats.json every few seconds with an atomic rename,
+# so no call pays for file I/O and concurrent sessions can't overwrite each other's counts.
+USAGE_FILE = "usage_stats.json"
+USAGE_FLUSH_SECONDS = 10
+
+class UsageTracker:
+    """In-memory token/cost counters, broken down by model, operation and day"""
+
+    def __init__(self, path=USAGE_FILE, flush_interval=USAGE_FLUSH_SECONDS):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.stats = {"total_tokens": 0, "total_cost": 0.0, "by_model": {}, "by_operation": {}, "by_day": {},
+                      "answer_cache": {"hits": 0, "misses": 0}}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.stats.update(json.load(f))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name="usage-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, tokens, cost, model, operation, type="input"):
+        day = datetime.now().strftime("%Y-%m-%d")
+        with self._lock:
+            self.stats["total_tokens"] += tokens
+            self.stats["total_cost"] += cost
+            for group, name in (("by_model", model), ("by_operation", operation), ("by_day", day)):
+                bucket = self.stats[group].setdefault(name, {"input_tokens": 0, "output_tokens": 0, "cost": 0.0})
+                bucket[f"{type}_tokens"] += tokens
+                bucket["cost"] += cost
+            self._dirty = True
+            return {"total_tokens": self.stats["total_tokens"], "total_cost": self.stats["total_cost"]}
+
+    def record_cache(self, hit):
+        with self._lock:
+            self.stats["answer_cache"]["hits" if hit else "misses"] += 1
+            self._dirty = True
+
+    def snapshot(self):
+        """Copy of the current counters (safe to read from the UI)"""
+        with self._lock:
+            return json.loads(json.dumps(self.stats))
+
+    def flush(self):
+        """Writes the counters to disk atomically, only if something changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self.stats)
+            self._dirty = False
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+        atexit.unregister(self.close)  # Evicted tenant trackers shouldn't stay referenced
+
+_usage_tracker = None
+_usage_tracker_lock = threading.Lock()
+# In multi-tenant mode every Streamlit script run points this at its tenant's tracker, so
+# track_usage() and cache hit/miss counts land in that user's vault
+_active_usage_tracker = contextvars.ContextVar("active_usage_tracker", default=None)
+
+def use_usage_tracker(tracker):
+    """Routes usage recorded in the current thread/context to tracker (None = process-wide)"""
+    _active_usage_tracker.set(tracker)
+
+def get_usage_tracker():
+    """The tracker of the active tenant, else the process-wide one (created on first use)"""
+    active = _active_usage_tracker.get()
+    if active is not None:
+        return active
+    global _usage_tracker
+    with _usage_tracker_lock:
+        if _usage_tracker is None:
+            _usage_tracker = UsageTracker()
+        return _usage_tracker
+
+def track_usage(text, type="input", model="gemini-2.5-flash-lite", operation="chat"):
     # Rough estimation: 1 token approx 4 characters
     tokens = len(text) / 4
     cost = (tokens / 1000) * 0.000125 # Estimate for Gemini 1.5 Flash
-    
-    # Save to a local JSON file to persist data
-    usage_file = "usage_stats.json"
-    stats = {"total_tokens": 0, "total_cost": 0.0}
-    
-    if os.path.exists(usage_file):
-        with open(usage_file, "r") as f:
-            stats = json.load(f)
-            
-    stats["total_tokens"] += tokens
-    stats["total_cost"] += cost
-    
-    with open(usage_file, "w") as f:
-        json.dump(stats, f)
-    
-    return stats
+    return get_usage_tracker().record(tokens, cost, model, operation, type)
+
+def get_usage_stats():
+    """Current usage counters, read from memory (no disk access)"""
+    return get_usage_tracker().snapshot()
 
 # --- 7. RAG & FEEDBACK ---
+# MiniLM only reads the first ~256 word pieces of its input, so long notes are split into
+# overlapping, sentence-aware chunks and every chunk gets its own vector.
+CHUNK_TOKENS = 180          # Per chunk, estimated as 1 token ~ 4 characters
+CHUNK_OVERLAP_SENTENCES = 1 # Sentences repeated at the start of the next chunk
+EMBED_BATCH_SIZE = 64
+RAG_TOP_K = 4
+RAG_MAX_CHUNKS_PER_NOTE = 1
+CONTEXT_TOKEN_BUDGET = 600
+
+def estimate_tokens(text):
+    # Same rough estimate as track_usage: 1 token approx 4 characters
+    return len(text) / 4
+
+def chunk_text(text, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP_SENTENCES):
+    """Splits text into overlapping chunks on sentence boundaries"""
+    if estimate_tokens(text) <= max_tokens:
+        return [text] if text.strip() else []
+    from nltk.tokenize import sent_tokenize
+    ensure_punkt()
+    sentences = []
+    for sentence in sent_tokenize(text):
+        # A single huge "sentence" (e.g. a pasted table) is cut on word boundaries
+        words = sentence.split()
+        piece = []
+        for word in words:
+            if piece and estimate_tokens(" ".join(piece + [word])) > max_tokens:
+                sentences.append(" ".join(piece))
+                piece = []
+            piece.append(word)
+        if piece:
+            sentences.append(" ".join(piece))
+
+    chunks, current = [], []
+    for sentence in sentences:
+        if current and estimate_tokens(" ".join(current + [sentence])) > max_tokens:
+            chunks.append(" ".join(current))
+            current = current[-overlap:] if overlap else []
+            if current and estimate_tokens(" ".join(current + [sentence])) > max_tokens:
+                current = []
+        current.append(sentence)
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+@instrument("rag.embed_texts")
+def embed_texts(texts, batch_size=EMBED_BATCH_SIZE):
+    """Encodes texts in length-sorted batches (less padding per batch), in the original order"""
+    if not texts:
+        return np.zeros((0, get_embed_model().get_sentence_embedding_dimension()), dtype='float32')
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    vectors = [None] * len(texts)
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        encoded = get_embed_model().encode([texts[i] for i in batch], batch_size=batch_size, normalize_embeddings=True)
+        for i, vector in zip(batch, encoded):
+            vectors[i] = vector
+    return np.asarray(vectors, dtype='float32')
+
+@instrument("rag.create_vector_index")
 def create_vector_index(notes):
-    """Turns notes into a searchable mathematical index"""
+    """Turns notes into a searchable mathematical index (one vector per chunk)"""
     if not notes:
         return None, []
     
-    # Extract only the text content
-    text_data = [n['content'] for n in notes]
+    # Extract only the text content, split into chunks
+    text_data = [chunk for n in notes for chunk in chunk_text(n['content'])]
+    if not text_data:
+        return None, []
     
     # Convert text to vectors (embeddings)
-    embeddings = embed_model.encode(text_data)
+    embeddings = embed_texts(text_data)
     
-    # Create the FAISS index
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(np.array(embeddings).astype('float32'))
+    # Create the FAISS index (flat / HNSW / IVF depending on size)
+    index = build_vector_index(embeddings)
     
     return index, text_data
 
-def query_vault(query, index, text_data, top_k=2):
-    """Finds the most relevant notes for a question"""
+@instrument("rag.embed_query")
+def embed_query(query):
+    """Embeds a question once so retrieval and the answer cache can share the vector"""
+    return np.asarray(get_embed_model().encode([query], normalize_embeddings=True)[0], dtype='float32')
+
+@instrument("rag.query_vault")
+def query_vault(query, index, text_data, top_k=2, query_vector=None):
+    """Finds the most relevant chunks for a question"""
     if index is None:
         return "No notes found to search."
         
     # Convert question to vector
-    query_vector = embed_model.encode([query])
+    if query_vector is None:
+        query_vector = embed_query(query)
     
     # Search the index
-    distances, indices = index.search(np.array(query_vector).astype('float32'), top_k)
+    distances, indices = index.search(np.asarray(query_vector, dtype='float32').reshape(1, -1), top_k)
     
-    # Pull the relevant text chunks
-    results = [text_data[i] for i in indices[0] if i != -1]
+    # Pull the relevant text chunks (overlapping chunks can repeat, keep the first)
+    results = []
+    for i in indices[0]:
+        if i != -1 and text_data[i] not in results:
+            results.append(text_data[i])
     return results
 
-def log_feedback(query, answer, context, status):
-    log_file = "feedback_log.json"
-    entry = {
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "query": query,
-        "answer": answer,
-        "context_used": context,
-        "status": status  # "Correct" or "Wrong"
-    }
-    
-    logs = []
-    if os.path.exists(log_file):
-        with open(log_file, "r") as f:
-            logs = json.load(f)
-            
-    logs.append(entry)
-    with open(log_file, "w") as f:
-        json.dump(logs, f, indent=4)
+def build_context(hits, token_budget=CONTEXT_TOKEN_BUDGET):
+    """Joins retrieved (note_id, chunk) hits, best first, until the token budget is used.
+    Returns (context_str, note_ids_used) so prompt size stays predictable."""
+    parts, used_ids, used_tokens = [], [], 0
+    for note_id, chunk in hits:
+        tokens = estimate_tokens(chunk)
+        if parts and used_tokens + tokens > token_budget:
+            continue
+        if not parts and tokens > token_budget:
+            chunk = chunk[:int(token_budget * 4)]  # Even the best chunk must fit
+            tokens = token_budget
+        parts.append(chunk)
+        used_tokens += tokens
+        if note_id not in used_ids:
+            used_ids.append(note_id)
+    return "\n".join(parts), used_ids
 
-# --- 8. GEMINI AI ENGINE ---
-def get_gemini_response(user_query, context_str):
-    """Connects to Google Gemini API for free AI logic"""
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        return "⚠️ Error: GEMINI_API_KEY not found in Hugging Face Secrets."
-    
+# --- 7a. VECTOR INDEX BACKENDS ---
+# Embeddings are L2-normalized, so inner product == cosine similarity (what MiniLM is
+# trained for). Small vaults use an exact flat index; bigger ones switch to HNSW, and
+# very big ones to IVF (trained on a sample). Thresholds are in vectors (= chunks);
+# use benchmark_index_backends() on your own data to pick them.
+INDEX_HNSW_THRESHOLD = int(os.getenv("VAULT_HNSW_THRESHOLD", "20000"))
+INDEX_IVF_THRESHOLD = int(os.getenv("VAULT_IVF_THRESHOLD", "500000"))
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+IVF_PROBE_FRACTION = 16     # nprobe = nlist / 16
+IVF_TRAIN_PER_LIST = 64     # Training sample size per inverted list
+INDEX_FILE = "vector_index.faiss"
+
+def choose_index_kind(n_vectors):
+    if n_vectors >= INDEX_IVF_THRESHOLD:
+        return "ivf"
+    if n_vectors >= INDEX_HNSW_THRESHOLD:
+        return "hnsw"
+    return "flat"
+
+# Storage modes trade index memory for accuracy (bytes per 384-dim vector): float32 1536,
+# float16 768, int8 384, pq 48. The index is the only copy of the vectors in memory; with
+# a compressed mode search() re-ranks the few top candidates against their float16 rows,
+# read back from the embeddings database per query. Switching modes re-embeds the vault
+# (fully reversible).
+INDEX_STORAGE = os.getenv("VAULT_INDEX_STORAGE", "float32")
+PQ_SUBQUANTIZERS = 48       # 384 dims / 48 = 8 dims per 1-byte code
+PQ_MIN_VECTORS = 10000      # PQ codebooks need enough training data; below this use int8
+PQ_TRAIN_VECTORS = 10000    # Codebook training sample (FAISS wants 39 per centroid, 256 centroids)
+RERANK_CANDIDATES = 16
+STORAGE_FACTORY = {"float32": "Flat", "float16": "SQfp16", "int8": "SQ8", "pq": f"PQ{PQ_SUBQUANTIZERS}"}
+
+@instrument("rag.build_vector_index")
+def build_vector_index(vectors, kind=None, storage=None, trained=None):
+    """Builds an inner-product FAISS index over normalized vectors. trained is an optional
+    dict the caller keeps between builds: the trained, still empty index is kept there and
+    the next build with the same layout copies it instead of training again."""
+    faiss = get_faiss()
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    n, dim = vectors.shape
+    kind = kind or choose_index_kind(n)
+    storage = storage or INDEX_STORAGE
+    if storage == "pq" and n < PQ_MIN_VECTORS:
+        storage = "int8"
+    codec = STORAGE_FACTORY[storage]
+    if kind == "hnsw":
+        description = f"HNSW{HNSW_M},{codec}"
+    elif kind == "ivf":
+        nlist = max(1, min(int(4 * math.sqrt(n)), n // 39 or 1))
+        description = f"IVF{nlist},{codec}"
+    else:
+        description = codec
+    if trained is not None and (dim, description) in trained:
+        index = faiss.clone_index(trained[(dim, description)])
+    else:
+        index = faiss.index_factory(dim, description, faiss.METRIC_INNER_PRODUCT)
+        if kind == "hnsw":
+            index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+        if not index.is_trained:
+            # PQ codebooks and IVF lists are trained on a bounded sample, so the cost of a
+            # rebuild doesn't grow with the vault
+            sample_size = PQ_TRAIN_VECTORS
+            if kind == "ivf":
+                sample_size = max(nlist * IVF_TRAIN_PER_LIST, sample_size if storage == "pq" else 0)
+            sample_size = min(n, sample_size)
+            sample = vectors[np.random.default_rng(0).choice(n, sample_size, replace=False)]
+            index.train(sample)
+            if trained is not None:
+                trained.clear()  # Only the current layout is worth keeping
+                trained[(dim, description)] = faiss.clone_index(index)
+    if kind == "ivf":
+        faiss.extract_index_ivf(index).nprobe = max(1, nlist // IVF_PROBE_FRACTION)
+    index.add(vectors)
+    return index
+
+def index_footprint(index):
+    """Serialized size of an index in bytes (close to its resident memory)"""
+    if index is None:
+        return 0
+    return int(get_faiss().serialize_index(index).size)
+
+def save_vector_index(index, path=INDEX_FILE, keyring=None):
+    """Persists an index atomically. With a keyring the bytes are encrypted (needed whenever
+    the index holds vectors of secret notes); without one it is a plain FAISS file that
+    load_vector_index can memory-map."""
+    faiss = get_faiss()
+    tmp_path = path + ".tmp"
+    if keyring is not None:
+        raw = base64.b64encode(faiss.serialize_index(index).tobytes()).decode()
+        with open(tmp_path, "w") as f:
+            f.write(keyring.encrypt(raw))
+    else:
+        faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+def load_vector_index(path=INDEX_FILE, keyring=None):
+    """Loads an index saved by save_vector_index; plain files are memory-mapped when the
+    index type supports it. Returns None if the file is missing or can't be decrypted."""
+    faiss = get_faiss()
+    if not os.path.exists(path):
+        return None
+    if keyring is not None:
+        with open(path, "r") as f:
+            raw = keyring.decrypt(f.read())
+        if raw == DECRYPTION_ERROR:
+            return None
+        return faiss.deserialize_index(np.frombuffer(base64.b64decode(raw), dtype='uint8'))
     try:
-        # New initialization style
-        client = genai.Client(api_key=api_key)
-        
-        prompt = f"""
+        return faiss.read_index(path, faiss.IO_FLAG_MMAP)
+    except RuntimeError:
+        return faiss.read_index(path)  # Some index types can't be memory-mapped
+
+def benchmark_index_backends(vectors, queries=None, k=10, kinds=("flat", "hnsw", "ivf"), n_queries=200,
+                             storages=("float32",)):
+    """Recall@k vs latency (and size) for each backend/storage mode, using the exact flat
+    index as ground truth. Returns [{"kind", "storage", "vectors", "build_s", "query_ms",
+    "recall_at_k", "index_bytes"}, ...]."""
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    if queries is None:
+        rng = np.random.default_rng(1)
+        queries = vectors[rng.choice(len(vectors), min(n_queries, len(vectors)), replace=False)]
+    queries = np.ascontiguousarray(queries, dtype='float32')
+    k = min(k, len(vectors))
+    _, truth = build_vector_index(vectors, "flat").search(queries, k)
+
+    report = []
+    for kind in kinds:
+        for storage in storages:
+            started = time.perf_counter()
+            index = build_vector_index(vectors, kind, storage)
+            build_s = time.perf_counter() - started
+            started = time.perf_counter()
+            _, found = index.search(queries, k)
+            query_ms = (time.perf_counter() - started) * 1000 / len(queries)
+            recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+            report.append({"kind": kind, "storage": storage, "vectors": len(vectors), "build_s": round(build_s, 3),
+                           "query_ms": round(query_ms, 4), "recall_at_k": round(float(recall), 4),
+                           "index_bytes": index_footprint(index)})
+    return report
+
+# --- 7b. PERSISTENT EMBEDDING STORE ---
+# Re-encoding the whole vault for every question is slow, so we keep the chunk vectors
+# of every note on disk, keyed by note id + a hash of its stored content. Only new or
+# changed notes get embedded. Vectors live in SQLite, one row per note, so saving or
+# deleting a note writes one row instead of the whole file, and only the FAISS index keeps
+# them in memory: rows are read back for a full rebuild, the delta index and re-ranking.
+# Vectors of secret notes are encrypted with the session key. Chunk texts are never saved;
+# they are re-derived from the (decrypted) notes in memory.
+EMBEDDINGS_DB = "embeddings.db"
+EMBEDDINGS_FILE = "embeddings.json"  # Old single-file format, migrated on first open
+
+def content_hash(content):
+    """SHA-256 of the stored note content (ciphertext for secret notes)"""
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def _chunking_signature():
+    # Saved vectors are only valid for the chunking settings they were made with
+    return [EMBED_MODEL_NAME, CHUNK_TOKENS, CHUNK_OVERLAP_SENTENCES, "normalized", INDEX_STORAGE]
+
+def _store_dtype():
+    # Exact vectors for float32 mode; compressed modes save half-size rows
+    return 'float32' if INDEX_STORAGE == "float32" else 'float16'
+
+
+class VectorStorage:
+    """SQLite table of chunk vectors, one row per note. Rows are only valid for the
+    chunking signature in the meta table; opening with other settings empties it."""
+
+    def __init__(self, path=EMBEDDINGS_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS vectors (note_id INTEGER PRIMARY KEY, hash TEXT NOT NULL, "
+                           "secret INTEGER NOT NULL, n_chunks INTEGER NOT NULL, data BLOB NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.commit()
+        signature = json.dumps(_chunking_signature())
+        if self.get_meta("chunking") != signature:
+            with self._lock, self._conn:
+                self._conn.execute("DELETE FROM vectors")
+                self._conn.execute("DELETE FROM meta")
+            self.set_meta("chunking", signature)
+
+    def get_meta(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def is_empty(self):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM vectors LIMIT 1").fetchone() is None
+
+    def iter_rows(self, note_ids=None, batch_size=1000):
+        """Yields (note_id, hash, secret, n_chunks, data) rows, all or just note_ids, in id order"""
+        if note_ids is not None:
+            note_ids = sorted(note_ids)
+            for start in range(0, len(note_ids), 500):  # Stay under SQLite's variable limit
+                part = note_ids[start:start + 500]
+                with self._lock:
+                    rows = self._conn.execute("SELECT note_id, hash, secret, n_chunks, data FROM vectors WHERE note_id IN "
+                                              f"({','.join('?' * len(part))}) ORDER BY note_id", part).fetchall()
+                yield from rows
+            return
+        last_id = -1
+        while True:
+            with self._lock:
+                rows = self._conn.execute("SELECT note_id, hash, secret, n_chunks, data FROM vectors WHERE note_id > ? "
+                                          "ORDER BY note_id LIMIT ?", (last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield from rows
+
+    def write(self, rows, deleted=()):
+        """Upserts (note_id, hash, secret, n_chunks, data) rows and deletes note ids, in one transaction"""
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO vectors (note_id, hash, secret, n_chunks, data) "
+                                   "VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.executemany("DELETE FROM vectors WHERE note_id = ?", [(note_id,) for note_id in deleted])
+
+# What readers search: swapped in as ONE object, so a reader never sees half an update.
+# index/row_map/texts are the last full build, dead its tombstoned rows (notes changed or
+# deleted since), delta a flat index over the notes added or changed since.
+# hashes are the content hashes of the notes it covers, index_bytes is measured at build time.
+IndexSnapshot = namedtuple("IndexSnapshot", ["index", "row_map", "texts", "dead", "delta", "delta_map",
+                                             "delta_texts", "hashes", "index_bytes", "built_at"])
+INDEX_DELTA_FRACTION = 0.1   # Full rebuild once delta + tombstones exceed this share of the index...
+INDEX_DELTA_MIN_ROWS = 2000  # ...or this many rows, whichever is larger
+
+class EmbeddingStore:
+    """Incrementally maintained chunk embeddings + FAISS index for one unlocked session"""
+
+    def __init__(self, keyring, path=EMBEDDINGS_DB, index_path=INDEX_FILE, legacy_file=None):
+        self.keyring = keyring
+        self.path = path
+        self.index_path = index_path
+        self.legacy_file = legacy_file
+        self.storage = VectorStorage(path)
+        self.records = {}   # note_id -> {"hash", "secret", "n_chunks"} (the vectors are in storage)
+        self.pending = {}   # note_id -> (n_chunks, dim) vectors embedded but not saved yet
+        self.texts = {}     # note_id -> readable text (memory only, never saved)
+        self.chunks = {}    # note_id -> list of chunk texts (memory only, never saved)
+        self.background = False  # True while an EmbeddingWorker owns all updates
+        self._snapshot = IndexSnapshot(None, [], [], frozenset(), None, [], [], {}, 0, 0.0)
+        self._base = None  # The last full index build and its row layout
+        self._trained = {}  # Trained, empty index reused by the next full build (see build_vector_index)
+        self._write_lock = threading.RLock()
+        self._dirty = True
+        self._unsaved = set()  # Note ids whose row has to be written (or deleted) by save()
+        self.resident_bytes = 0  # Texts + unsaved vectors + index, measured when an index is published
+        self.load()
+
+    def _encode_row(self, note_id, rec, vectors):
+        data = vectors.astype(_store_dtype()).tobytes()
+        if rec["secret"]:
+            data = self.keyring.encrypt(base64.b64encode(data).decode())
+        return (note_id, rec["hash"], int(rec["secret"]), len(vectors), data)
+
+    def _decode_row(self, secret, data, dim):
+        """The vectors of one row, or None if they are secret and the key can't open them"""
+        if secret:
+            data = self.keyring.decrypt(data)
+            if data == DECRYPTION_ERROR:
+                return None
+            data = base64.b64decode(data)
+        return np.frombuffer(data, dtype=_store_dtype()).reshape(-1, dim)
+
+    def load(self):
+        """Reads which notes have saved vectors; secret ones we can't decrypt are simply
+        re-embedded later. The vectors themselves stay on disk."""
+        self._migrate_legacy()
+        dim = self.storage.get_meta("dim")
+        if dim is None:
+            return
+        for note_id, row_hash, secret, n_chunks, data in self.storage.iter_rows():
+            if secret and self._decode_row(secret, data, int(dim)) is None:
+                continue
+            self.records[note_id] = {"hash": row_hash, "secret": bool(secret), "n_chunks": n_chunks}
+
+    def _iter_vectors(self, note_ids=None):
+        """Yields (note_id, vectors) for the current records, all or just note_ids: unsaved
+        ones from memory, the rest read from storage"""
+        dim = self.storage.get_meta("dim")
+        wanted = set(self.records) if note_ids is None else {i for i in note_ids if i in self.records}
+        for note_id in list(wanted):
+            vectors = self.pending.get(note_id)
+            if vectors is not None:
+                wanted.discard(note_id)
+                yield note_id, vectors
+        if not wanted or dim is None:
+            return
+        rows = self.storage.iter_rows() if note_ids is None else self.storage.iter_rows(note_ids=wanted)
+        for note_id, row_hash, secret, _, data in rows:
+            rec = self.records.get(note_id)
+            if note_id in wanted and rec is not None and rec["hash"] == row_hash:
+                vectors = self._decode_row(secret, data, int(dim))
+                if vectors is not None:
+                    yield note_id, vectors
+
+    def _migrate_legacy(self):
+        """One-time import of the old embeddings.json (unreadable secret entries are dropped)"""
+        if not self.legacy_file or not os.path.exists(self.legacy_file) or not self.storage.is_empty():
+            return
+        with open(self.legacy_file, "r") as f:
+            data = json.load(f)
+        if data.get("chunking") == _chunking_signature() and data.get("dim"):
+            for note_id, rec in data.get("notes", {}).items():
+                payload = rec["vectors"] if not rec.get("secret") else self.keyring.decrypt(rec["vectors"])
+                if payload == DECRYPTION_ERROR:
+                    continue
+                vectors = np.frombuffer(base64.b64decode(payload), dtype=_store_dtype()).reshape(-1, data["dim"])
+                self.records[int(note_id)] = {"hash": rec["hash"], "secret": rec.get("secret", False), "n_chunks": len(vectors)}
+                self.pending[int(note_id)] = vectors
+                self._unsaved.add(int(note_id))
+            self.save()
+            self.records.clear()  # load() reads them back from the table
+        os.replace(self.legacy_file, self.legacy_file + ".migrated")
+
+    def save(self):
+        """Writes the rows of notes embedded or removed since the last save, in one
+        transaction, and drops their vectors from memory"""
+        with self._write_lock:
+            note_ids, self._unsaved = self._unsaved, set()
+            rows = [self._encode_row(note_id, self.records[note_id], self.pending[note_id])
+                    for note_id in note_ids if note_id in self.records]
+            deleted = [note_id for note_id in note_ids if note_id not in self.records]
+            if rows and self.storage.get_meta("dim") is None:
+                self.storage.set_meta("dim", self.pending[rows[0][0]].shape[1])
+            if rows or deleted:
+                self.storage.write(rows, deleted)
+            for note_id in note_ids:
+                self.pending.pop(note_id, None)
+
+    @instrument("rag.store_sync")
+    def sync(self, notes, save=True):
+        """Brings the store in line with the notes list; returns how many notes were embedded"""
+        texts = get_notes_text(notes, self.keyring)
+        with self._write_lock:
+            current_ids = set()
+            to_embed = []
+            for note, text in zip(notes, texts):
+                current_ids.add(note['id'])
+                self._set_text(note['id'], text)
+                rec = self.records.get(note['id'])
+                if rec is None or rec["hash"] != note_hash(note):
+                    to_embed.append(note)
+
+            removed = [note_id for note_id in self.records if note_id not in current_ids]
+            for note_id in removed:
+                self.records.pop(note_id, None)
+                self.pending.pop(note_id, None)
+                self.texts.pop(note_id, None)
+                self.chunks.pop(note_id, None)
+                self._unsaved.add(note_id)
+
+            if to_embed:
+                self._embed(to_embed)
+            if to_embed or removed:
+                self._dirty = True
+                if save:
+                    self.save()
+        return len(to_embed)
+
+    def upsert_many(self, notes, save=True):
+        """Re-embeds only the notes whose content changed; returns how many were embedded"""
+        texts = get_notes_text(notes, self.keyring)
+        with self._write_lock:
+            changed = []
+            for note, text in zip(notes, texts):
+                self._set_text(note['id'], text)
+                rec = self.records.get(note['id'])
+                if rec is None or rec["hash"] != note_hash(note) or rec["secret"] != note.get('secret', False):
+                    changed.append(note)
+            if changed:
+                self._embed(changed)
+                self._dirty = True
+                if save:
+                    self.save()
+        return len(changed)
+
+    def upsert(self, note):
+        """Call after a note is saved: re-embeds it only if its content changed"""
+        return self.upsert_many([note]) > 0
+
+    def remove_many(self, note_ids, save=True):
+        with self._write_lock:
+            removed = 0
+            for note_id in note_ids:
+                self.texts.pop(note_id, None)
+                self.chunks.pop(note_id, None)
+                self.pending.pop(note_id, None)
+                if self.records.pop(note_id, None) is not None:
+                    self._unsaved.add(note_id)
+                    removed += 1
+            if removed:
+                self._dirty = True
+                if save:
+                    self.save()
+        return removed
+
+    def remove(self, note_id):
+        """Call after a note is deleted"""
+        self.remove_many([note_id])
+
+    def _set_text(self, note_id, text):
+        if self.texts.get(note_id) != text:
+            self.texts[note_id] = text
+            self.chunks.pop(note_id, None)
+
+    def _get_chunks(self, note_id):
+        if note_id not in self.chunks:
+            self.chunks[note_id] = chunk_text(self.texts[note_id])
+        return self.chunks[note_id]
+
+    def _embed(self, notes):
+        """Embeds the chunks of all given notes in one length-sorted batch run"""
+        all_chunks, spans = [], []
+        for note in notes:
+            note_chunks = self._get_chunks(note['id'])
+            spans.append((len(all_chunks), len(all_chunks) + len(note_chunks)))
+            all_chunks.extend(note_chunks)
+        vectors = embed_texts(all_chunks)
+        for note, (start, end) in zip(notes, spans):
+            self.records[note['id']] = {"hash": note_hash(note),
+                                        "secret": note.get('secret', False),
+                                        "n_chunks": end - start}
+            self.pending[note['id']] = vectors[start:end].astype(_store_dtype())
+            self._unsaved.add(note['id'])
+
+    def _measure(self, snap):
+        text_chars = sum(len(t) for t in self.texts.values())
+        self.resident_bytes = int(2 * text_chars  # Note texts + their chunks
+                                  + sum(v.nbytes for v in self.pending.values()) + snap.index_bytes)
+        return snap
+
+    def _live_records(self):
+        """Notes whose vectors match their current chunks (i.e. can be searched), in store order"""
+        return [(note_id, rec) for note_id, rec in self.records.items()
+                if note_id in self.texts and len(self._get_chunks(note_id)) == rec["n_chunks"]]
+
+    def _stack(self, live):
+        """float32 matrix of the vectors of the live records, rows in their order"""
+        vectors = dict(self._iter_vectors(note_id for note_id, _ in live))
+        return np.vstack([vectors[note_id] for note_id, _ in live]).astype('float32')
+
+    def publish(self):
+        """Swaps in an index for the current vectors. Usually only the delta is rebuilt: a
+        small flat index over the notes added or changed since the last full build, with
+        the base rows they replaced tombstoned. The full index is rebuilt once the delta
+        grows past INDEX_DELTA_FRACTION of it, or the vault crosses an index-kind threshold."""
+        with self._write_lock:
+            live = self._live_records()
+            n_rows = sum(rec["n_chunks"] for _, rec in live)
+            if self._base is None:
+                self._base = self._load_saved_index()
+            base = self._base
+            if base is None or base["kind"] != choose_index_kind(n_rows):
+                return self._full_publish(live)
+
+            current = {note_id: rec["hash"] for note_id, rec in live}
+            dead = set()
+            for note_id, (start, end) in base["spans"].items():
+                if current.get(note_id) != base["hashes"][note_id]:
+                    dead.update(range(start, end))
+            changed = [(note_id, rec) for note_id, rec in live if base["hashes"].get(note_id) != rec["hash"]]
+            delta_rows = sum(rec["n_chunks"] for _, rec in changed)
+            if delta_rows + len(dead) > max(INDEX_DELTA_MIN_ROWS, INDEX_DELTA_FRACTION * len(base["row_map"])):
+                return self._full_publish(live)
+
+            delta, delta_map = None, []
+            if delta_rows:
+                delta = build_vector_index(self._stack(changed), "flat", "float32")
+                delta_map = [(note_id, j) for note_id, rec in changed for j in range(rec["n_chunks"])]
+            delta_texts = [self.chunks[note_id][j] for note_id, j in delta_map]
+            index_bytes = base["index_bytes"] + (delta.ntotal * delta.d * 4 if delta is not None else 0)
+            self._snapshot = IndexSnapshot(base["index"], base["row_map"], base["texts"], frozenset(dead),
+                                           delta, delta_map, delta_texts, current, index_bytes, time.time())
+            self._dirty = False
+        return self._measure(self._snapshot)
+
+    def _full_publish(self, live):
+        """Rebuilds the whole index (flat/HNSW/IVF for the current size) and saves it"""
+        row_map = [(note_id, j) for note_id, rec in live for j in range(rec["n_chunks"])]
+        index = build_vector_index(self._stack(live), trained=self._trained) if row_map else None  # The matrix only lives for the build
+        self._base = self._make_base(index, [(note_id, rec["hash"], rec["n_chunks"]) for note_id, rec in live],
+                                     index_footprint(index))  # Serialized once per full build, not per rerun
+        if index is not None:
+            self._save_index(self._base)
+        self._snapshot = IndexSnapshot(index, row_map, self._base["texts"], frozenset(), None, [], [],
+                                       dict(self._base["hashes"]), self._base["index_bytes"], time.time())
+        self._dirty = False
+        return self._measure(self._snapshot)
+
+    def _make_base(self, index, layout, index_bytes):
+        """Bookkeeping of a full index; layout is [(note_id, hash, n_rows), ...] in row order.
+        Rows of notes that changed since get no text: they are tombstoned anyway."""
+        row_map, texts, spans, hashes = [], [], {}, {}
+        for note_id, row_hash, n in layout:
+            spans[note_id] = (len(row_map), len(row_map) + n)
+            hashes[note_id] = row_hash
+            row_map.extend((note_id, j) for j in range(n))
+            rec = self.records.get(note_id)
+            if rec is not None and rec["hash"] == row_hash and note_id in self.texts and len(self._get_chunks(note_id)) == n:
+                texts.extend(self.chunks[note_id])
+            else:
+                texts.extend([""] * n)
+        return {"index": index, "kind": choose_index_kind(len(row_map)), "layout": layout, "index_bytes": index_bytes,
+                "row_map": row_map, "texts": texts, "spans": spans, "hashes": hashes}
+
+    def vectors(self):
+        """All searchable vectors as one float32 matrix (e.g. for benchmark_index_backends)"""
+        with self._write_lock:
+            live = self._live_records()
+            return self._stack(live) if live else np.zeros((0, 0), dtype='float32')
+
+    def current(self):
+        """The index readers should use; in background mode never waits for a rebuild"""
+        if self._dirty and not self.background:
+            return self.publish()
+        return self._snapshot
+
+    def footprint(self):
+        """Memory report: index bytes, on-disk vector bytes, mode and vector count (all
+        recorded when the index was published, so this costs nothing per rerun)"""
+        snap = self.current()
+        n_vectors = len(snap.row_map) - len(snap.dead) + len(snap.delta_map)
+        dim = snap.index.d if snap.index is not None else snap.delta.d if snap.delta is not None else 0
+        return {"storage": INDEX_STORAGE, "vectors": n_vectors, "index_bytes": snap.index_bytes,
+                "disk_bytes": n_vectors * dim * np.dtype(_store_dtype()).itemsize}
+
+    def _has_secret_rows(self):
+        return any(rec["secret"] for rec in self.records.values())
+
+    def _load_saved_index(self):
+        """The full index saved by the last rebuild, if it was made with these settings and
+        the key still opens it; publish() then only has to index what changed since"""
+        meta_path = self.index_path + ".json"
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        if meta.get("chunking") != _chunking_signature() or "layout" not in meta:
+            return None
+        index = load_vector_index(self.index_path, self.keyring if meta.get("encrypted") else None)
+        if index is None:
+            return None
+        return self._make_base(index, [tuple(entry) for entry in meta["layout"]], meta.get("index_bytes", 0))
+
+    def _save_index(self, base):
+        encrypted = self._has_secret_rows()
+        save_vector_index(base["index"], self.index_path, self.keyring if encrypted else None)
+        meta = {"chunking": _chunking_signature(), "encrypted": encrypted, "kind": base["kind"],
+                "index_bytes": base["index_bytes"], "layout": base["layout"]}
+        tmp_path = self.index_path + ".json.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.index_path + ".json")
+
+    def _candidates(self, snap, query_vector, fetch):
+        """Up to fetch (score, (note_id, chunk_no), chunk_text) from the base index (minus
+        tombstones) and the delta index, best first"""
+        found = []
+        if snap.index is not None:
+            k = min(len(snap.row_map), fetch + min(len(snap.dead), 3 * fetch))  # Over-fetch past tombstones
+            scores, indices = snap.index.search(query_vector, k)
+            found += [(float(d), snap.row_map[i], snap.texts[i]) for d, i in zip(scores[0], indices[0])
+                      if i != -1 and i not in snap.dead]
+        if snap.delta is not None:
+            scores, indices = snap.delta.search(query_vector, min(len(snap.delta_map), fetch))
+            found += [(float(d), snap.delta_map[i], snap.delta_texts[i]) for d, i in zip(scores[0], indices[0]) if i != -1]
+        found.sort(key=lambda c: -c[0])
+        return found[:fetch]
+
+    def _rescore(self, snap, candidates, query_vector):
+        """Re-scores the candidates against their saved float16 rows, read from storage for
+        just these notes (a note changed since the snapshot keeps its approximate score)"""
+        note_ids = {note_id for _, (note_id, _), _ in candidates
+                    if note_id in self.records and self.records[note_id]["hash"] == snap.hashes.get(note_id)}
+        vectors = dict(self._iter_vectors(note_ids))
+        rescored = []
+        for score, (note_id, j), text in candidates:
+            if note_id in vectors:
+                score = float(vectors[note_id][j].astype('float32') @ query_vector)
+            rescored.append((score, (note_id, j), text))
+        rescored.sort(key=lambda c: -c[0])
+        return rescored
+
+    @instrument("rag.faiss_search")
+    def search(self, query_vector, top_k=RAG_TOP_K, max_per_note=RAG_MAX_CHUNKS_PER_NOTE):
+        """Returns up to top_k [(note_id, chunk_text), ...], best first, with at most
+        max_per_note chunks from any single note"""
+        snap = self.current()
+        if snap.index is None and snap.delta is None:
+            return []
+        # Over-fetch so deduplication still leaves top_k results
+        fetch = top_k * max(4, max_per_note * 2)
+        if INDEX_STORAGE != "float32":
+            fetch = max(fetch, RERANK_CANDIDATES)
+        query_vector = np.asarray(query_vector, dtype='float32').reshape(1, -1)
+        candidates = self._candidates(snap, query_vector, fetch)
+        if INDEX_STORAGE != "float32" and candidates:
+            # Compressed scores are approximate: re-score the few candidates with the saved vectors
+            candidates = self._rescore(snap, candidates, query_vector[0])
+        hits, per_note = [], {}
+        for _, (note_id, _), text in candidates:
+            if per_note.get(note_id, 0) >= max_per_note:
+                continue
+            per_note[note_id] = per_note.get(note_id, 0) + 1
+            hits.append((note_id, text))
+            if len(hits) == top_k:
+                break
+        return hits
+
+# --- 7b1. BACKGROUND EMBEDDING WORKER ---
+# Saving a note must never wait for the model. The UI only queues "upsert"/"delete"/"sync"
+# events; one worker thread drains them in batches, embeds all dirty notes in one pass,
+# builds a new index off to the side and swaps it in. Readers keep using the previous
+# index until then. On auto-lock the queue is purged so nothing outlives the session.
+EMBED_WORKER_BATCH = 64
+EMBED_WORKER_WAIT_SECONDS = 0.25  # How long to wait for more events before a batch runs
+_WORKER_STOP = object()
+
+class EmbeddingWorker:
+    """Single background thread that applies note events to an EmbeddingStore"""
+
+    def __init__(self, store, batch_size=EMBED_WORKER_BATCH, batch_wait=EMBED_WORKER_WAIT_SECONDS):
+        self.store = store
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.last_error = None
+        self._queue = queue.Queue()
+        self._enqueued_at = deque()  # Enqueue times of events not applied yet (FIFO)
+        self._lock = threading.Lock()
+        store.background = True
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed-worker")
+        self._future = self._executor.submit(self._run)
+
+    def _put(self, event):
+        with self._lock:
+            self._enqueued_at.append(time.time())
+        self._queue.put(event)
+
+    def submit_sync(self, notes):
+        self._put(("sync", list(notes)))
+
+    def submit_upsert(self, note):
+        self._put(("upsert", dict(note)))
+
+    def submit_delete(self, note_id):
+        self._put(("delete", note_id))
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            if event is _WORKER_STOP:
+                return
+            batch = [event]
+            deadline = time.monotonic() + self.batch_wait
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    event = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if event is _WORKER_STOP:
+                    stop = True
+                    break
+                batch.append(event)
+            self._apply(batch)
+            if stop:
+                return
+
+    def _apply(self, batch):
+        # Coalesce: the last event per note wins, and a full sync replaces what came before it
+        sync_notes, upserts, deletes = None, {}, set()
+        for kind, payload in batch:
+            if kind == "sync":
+                sync_notes, upserts, deletes = payload, {}, set()
+            elif kind == "upsert":
+                upserts[payload['id']] = payload
+                deletes.discard(payload['id'])
+            else:
+                upserts.pop(payload, None)
+                deletes.add(payload)
+        try:
+            if sync_notes is not None:
+                self.store.sync(sync_notes, save=False)
+            if upserts:
+                self.store.upsert_many(list(upserts.values()), save=False)
+            if deletes:
+                self.store.remove_many(deletes, save=False)
+            self.store.save()
+            self.store.publish()
+            self.last_error = None
+        except Exception as e:
+            self.last_error = str(e)
+        finally:
+            with self._lock:
+                for _ in batch:
+                    if self._enqueued_at:
+                        self._enqueued_at.popleft()
+
+    def status(self):
+        """{"pending": events not yet indexed, "stale_seconds": age of the oldest one,
+        "index_age_seconds": time since the current index was swapped in, "error": last error}"""
+        with self._lock:
+            pending = len(self._enqueued_at)
+            oldest = self._enqueued_at[0] if self._enqueued_at else None
+        built_at = self.store._snapshot.built_at
+        now = time.time()
+        return {"pending": pending, "stale_seconds": round(now - oldest, 1) if oldest else 0.0,
+                "index_age_seconds": round(now - built_at, 1) if built_at else None, "error": self.last_error}
+
+    def shutdown(self, purge=False, wait=True):
+        """Stops the worker; purge=True drops queued events without processing them"""
+        if purge:
+            try:
+                while True:
+                    self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            with self._lock:
+                self._enqueued_at.clear()
+        self._queue.put(_WORKER_STOP)
+        self._executor.shutdown(wait=wait)
+
+# --- 7b2. SEMANTIC ANSWER CACHE ---
+# Repeated questions skip the Gemini call: an answer is reused when a new question's
+# embedding is close enough (cosine) to a cached one AND retrieval returned exactly the
+# same context. Entries remember which notes they came from, so saving or deleting one
+# of those notes drops them. Bounded by LRU size + TTL, encrypted at rest. One cache per
+# vault, shared by its unlocked sessions (each save rewrites the whole file).
+ANSWER_CACHE_FILE = "answer_cache.bin"
+ANSWER_CACHE_MAX_ENTRIES = 256
+ANSWER_CACHE_TTL_SECONDS = 24 * 3600
+ANSWER_CACHE_SIMILARITY = 0.92
+
+class AnswerCache:
+    """LRU + TTL cache of AI answers keyed by query embedding and context hash"""
+
+    def __init__(self, keyring, path=ANSWER_CACHE_FILE, max_entries=ANSWER_CACHE_MAX_ENTRIES,
+                 ttl_seconds=ANSWER_CACHE_TTL_SECONDS, similarity=ANSWER_CACHE_SIMILARITY):
+        self.keyring = keyring
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity = similarity
+        self.entries = OrderedDict()  # entry_id -> {"vector", "context_hash", "note_ids", "answer", "created"}
+        self._lock = threading.RLock()  # A vault's sessions share one cache
+        self.load()
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype='float32').ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def load(self):
+        """Reads the encrypted cache file; a wrong key or corrupt file just means an empty cache"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as f:
+            raw = self.keyring.decrypt(f.read())
+        if raw == DECRYPTION_ERROR:
+            return
+        for entry_id, e in json.loads(raw).items():
+            e["vector"] = np.asarray(e["vector"], dtype='float32')
+            self.entries[entry_id] = e
+        self._evict()
+
+    def save(self):
+        with self._lock:
+            out = {entry_id: {**e, "vector": e["vector"].tolist()} for entry_id, e in self.entries.items()}
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(self.keyring.encrypt(json.dumps(out)))
+            os.replace(tmp_path, self.path)
+
+    def _evict(self):
+        now = time.time()
+        for entry_id in [k for k, e in self.entries.items() if now - e["created"] > self.ttl_seconds]:
+            del self.entries[entry_id]
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    @instrument("rag.answer_cache_lookup")
+    def lookup(self, query_vector, context_hash):
+        """Returns a cached answer or None; counts the hit/miss in the usage stats"""
+        vector = self._normalize(query_vector)
+        with self._lock:
+            self._evict()
+            for entry_id, e in self.entries.items():
+                if e["context_hash"] == context_hash and float(np.dot(vector, e["vector"])) >= self.similarity:
+                    self.entries.move_to_end(entry_id)
+                    get_usage_tracker().record_cache(hit=True)
+                    return e["answer"]
+        get_usage_tracker().record_cache(hit=False)
+        return None
+
+    def store(self, query_vector, context_hash, note_ids, answer):
+        """Caches a complete answer (only call it when the stream finished without error)"""
+        if answer.startswith(("❌", "⚠️")) or "❌ AI Engine Error" in answer:
+            return  # Never cache errors, including a stream that failed half way
+        entry_id = secrets.token_hex(8)
+        with self._lock:
+            self.entries[entry_id] = {"vector": self._normalize(query_vector), "context_hash": context_hash,
+                                      "note_ids": list(note_ids), "answer": answer, "created": time.time()}
+            self._evict()
+            self.save()
+
+    def invalidate_note(self, note_id):
+        """Drops every answer that used this note (call on save/delete)"""
+        with self._lock:
+            stale = [k for k, e in self.entries.items() if note_id in e["note_ids"]]
+            for entry_id in stale:
+                del self.entries[entry_id]
+            if stale:
+                self.save()
+
+# --- 7c. FEEDBACK LOG ---
+# Feedback is appended as one JSON line per click (no full-file rewrite). When the log
+# gets big it is rotated into a timestamped segment (gzipped by default). The retrieved
+# context is stored once per unique text in a side file and entries only keep its hash.
+FEEDBACK_FILE = "feedback_log.jsonl"
+FEEDBACK_CONTEXTS_FILE = "feedback_contexts.jsonl"
+LEGACY_FEEDBACK_FILE = "feedback_log.json"
+FEEDBACK_MAX_BYTES = 5 * 1024 * 1024
+
+class FeedbackLog:
+    """Append-only JSONL feedback log with size-based rotation"""
+
+    def __init__(self, path=FEEDBACK_FILE, contexts_path=FEEDBACK_CONTEXTS_FILE,
+                 max_bytes=FEEDBACK_MAX_BYTES, compress=True, legacy_file=LEGACY_FEEDBACK_FILE):
+        self.path = path
+        self.contexts_path = contexts_path
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self._lock = threading.Lock()
+        self._known_contexts = None
+        if legacy_file and os.path.exists(legacy_file):
+            self._migrate_legacy(legacy_file)
+
+    def _migrate_legacy(self, legacy_file):
+        """One-time conversion of the old feedback_log.json list"""
+        with open(legacy_file, "r") as f:
+            old_entries = json.load(f)
+        for entry in old_entries:
+            self.append(entry["query"], entry["answer"], entry.get("context_used", ""), entry["status"],
+                        timestamp=entry.get("timestamp"))
+        os.replace(legacy_file, legacy_file + ".migrated")
+
+    def _store_context(self, context):
+        h = hashlib.sha256(context.encode()).hexdigest()
+        if self._known_contexts is None:
+            self._known_contexts = set()
+            if os.path.exists(self.contexts_path):
+                with open(self.contexts_path, "r") as f:
+                    for line in f:
+                        self._known_contexts.add(json.loads(line)["hash"])
+        if h not in self._known_contexts:
+            with open(self.contexts_path, "a") as f:
+                f.write(json.dumps({"hash": h, "context": context}) + "\n")
+            self._known_contexts.add(h)
+        return h
+
+    def append(self, query, answer, context, status, timestamp=None):
+        entry = {
+            "timestamp": timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "query": query,
+            "answer": answer,
+            "context_hash": None,
+            "status": status  # "Correct" or "Wrong"
+        }
+        with self._lock:
+            entry["context_hash"] = self._store_context(context)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            if os.path.getsize(self.path) >= self.max_bytes:
+                self._rotate()
+        return entry
+
+    def _rotate(self):
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        base, ext = os.path.splitext(self.path)
+        segment = f"{base}.{stamp}{ext}"
+        os.replace(self.path, segment)
+        if self.compress:
+            with open(segment, "rb") as src, gzip.open(segment + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(segment)
+
+    def segments(self):
+        """All log files, oldest first (rotated segments, then the live file)"""
+        base, ext = os.path.splitext(self.path)
+        pattern = f"{glob.escape(base)}.[0-9]*{ext}"
+        rotated = sorted(glob.glob(pattern) + glob.glob(pattern + ".gz"))
+        if os.path.exists(self.path):
+            rotated.append(self.path)
+        return rotated
+
+    def iter_entries(self):
+        """Streams every entry one at a time; never loads the whole history"""
+        for segment in self.segments():
+            opener = gzip.open if segment.endswith(".gz") else open
+            with opener(segment, "rt") as f:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+
+    def get_context(self, context_hash):
+        """Looks up the full context text for an entry (streams the context file)"""
+        if not os.path.exists(self.contexts_path):
+            return None
+        with open(self.contexts_path, "r") as f:
+            for line in f:
+                rec = json.loads(line)
+                if rec["hash"] == context_hash:
+                    return rec["context"]
+        return None
+
+    def accuracy_stats(self, period="day"):
+        """Correct vs Wrong counts per day (or "month"), computed in one streaming pass"""
+        cut = 10 if period == "day" else 7
+        stats = {}
+        for entry in self.iter_entries():
+            bucket = stats.setdefault(entry["timestamp"][:cut], {"Correct": 0, "Wrong": 0})
+            bucket[entry["status"]] = bucket.get(entry["status"], 0) + 1
+        for bucket in stats.values():
+            total = bucket["Correct"] + bucket["Wrong"]
+            bucket["accuracy"] = bucket["Correct"] / total if total else None
+        return stats
+
+_feedback_log = None
+
+def get_feedback_log():
+    global _feedback_log
+    if _feedback_log is None:
+        _feedback_log = FeedbackLog()
+    return _feedback_log
+
+@instrument("feedback.log")
+def log_feedback(query, answer, context, status, log=None):
+    return (log or get_feedback_log()).append(query, answer, context, status)
+
+def get_feedback_stats(period="day"):
+    """Retrieval accuracy over time, e.g. {"2026-01-05": {"Correct": 3, "Wrong": 1, "accuracy": 0.75}}"""
+    return get_feedback_log().accuracy_stats(period)
+
+# --- 8. GEMINI AI ENGINE ---
+# One client per process, a token bucket that only waits when the per-minute quota is
+# actually used up (instead of a fixed 2s sleep), retries with exponential backoff on
+# 429/5xx, and streaming so the answer shows up token by token.
+# For tests, point GEMINI_BASE_URL at a local stub server or call set_gemini_client(stub).
+GEMINI_MODEL = "gemini-2.5-flash-lite"
+GEMINI_REQUESTS_PER_MINUTE = int(os.getenv("GEMINI_RPM", "15"))
+GEMINI_MAX_RETRIES = 4
+GEMINI_BACKOFF_SECONDS = 1.0
+
+class TokenBucket:
+    """Thread-safe token bucket: acquire() returns immediately while there is quota left"""
+
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes one token, sleeping only as long as needed; returns the seconds waited"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1  # Reserve our slot even if we have to wait for it
+            wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+gemini_rate_limiter = TokenBucket(GEMINI_REQUESTS_PER_MINUTE / 60.0, GEMINI_REQUESTS_PER_MINUTE)
+_gemini_client = None
+_gemini_client_lock = threading.Lock()
+
+def set_gemini_client(client):
+    """Swaps in any object with a genai-style `models` API (e.g. a local stub for tests)"""
+    global _gemini_client
+    with _gemini_client_lock:
+        _gemini_client = client
+
+def get_gemini_client():
+    """Shared Gemini client, created on first use; None if no API key is configured"""
+    global _gemini_client
+    with _gemini_client_lock:
+        if _gemini_client is None:
+            api_key = os.getenv("GEMINI_API_KEY")
+            if not api_key:
+                return None
+            from google import genai  # Gemini (imported on first question)
+            from google.genai import types
+            base_url = os.getenv("GEMINI_BASE_URL")
+            http_options = types.HttpOptions(base_url=base_url) if base_url else None
+            _gemini_client = genai.Client(api_key=api_key, http_options=http_options)
+        return _gemini_client
+
+def _is_retryable(error):
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    return isinstance(code, int) and (code == 429 or 500 <= code < 600)
+
+def _build_prompt(user_query, context_str):
+    return f"""
         You are a secure vault assistant. Use the following retrieved notes to answer.
         Notes Context: {context_str}
         User Question: {user_query}
         """
-        
-        # Inside your loop or before you call the model
-        time.sleep(2) # Wait 2 seconds between requests
-        # Simplified model call
-        response = client.models.generate_content(
-            model="gemini-2.5-flash-lite", 
-            contents=prompt
-        )
-        
-        track_usage(prompt, type="input")
-        track_usage(response.text, type="output")
-        return response.text
-    except Exception as e:
-        return f"❌ AI Engine Error: {str(e)}"
\ No newline at end of file
+
+def stream_gemini_response(user_query, context_str, status=None):
+    """Yields the answer piece by piece as Gemini generates it. If given, status["complete"]
+    is set to True only once the whole answer came through (no error, no cut-off stream)."""
+    status = status if status is not None else {}
+    status["complete"] = False
+    client = get_gemini_client()
+    if client is None:
+        yield "⚠️ Error: GEMINI_API_KEY not found in Hugging Face Secrets."
+        return
+
+    prompt = _build_prompt(user_query, context_str)
+    parts = []
+    started = time.perf_counter()
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        try:
+            metrics.observe("gemini.rate_limit_wait", gemini_rate_limiter.acquire())
+            for chunk in client.models.generate_content_stream(model=GEMINI_MODEL, contents=prompt):
+                if chunk.text:
+                    if not parts:
+                        metrics.observe("gemini.first_token", time.perf_counter() - started)
+                    parts.append(chunk.text)
+                    yield chunk.text
+            metrics.observe("gemini.round_trip", time.perf_counter() - started)
+            status["complete"] = True
+            break
+        except Exception as e:
+            # We can only retry safely if nothing has been shown to the user yet
+            if parts or attempt == GEMINI_MAX_RETRIES or not _is_retryable(e):
+                yield f"❌ AI Engine Error: {str(e)}"
+                return
+            metrics.inc("gemini.retries")
+            time.sleep(GEMINI_BACKOFF_SECONDS * (2 ** attempt) + random.uniform(0, 0.5))
+
+    track_usage(prompt, type="input", model=GEMINI_MODEL, operation="chat")
+    track_usage("".join(parts), type="output", model=GEMINI_MODEL, operation="chat")
+
+def get_gemini_response(user_query, context_str):
+    """Connects to Google Gemini API for free AI logic (non-streaming)"""
+    return "".join(stream_gemini_response(user_query, context_str))
+
+# --- 9. VAULTS & MULTI-TENANT MODE ---
+# A Vault is one directory holding every file of one vault (config, notes.db, embeddings,
+# index, answer cache, feedback, usage) plus the note list that all of its sessions share,
+# so sessions no longer keep their own copy of the notes. While any session is unlocked
+# the vault also holds ONE embedding store (with its worker) and full-text index for all
+# of them, dropped when the last one locks. Single-user mode is Vault(".") with the usual
+# file names. With VAULT_MULTI_TENANT=1 each logged-in user gets a vault under
+# TENANTS_DIR, opened on first use; once the open vaults go over the memory budget
+# (notes, store and index all count), the least recently used ones without an unlocked
+# session are evicted. The embedding model, FAISS module and Gemini client stay
+# process-wide, so an extra user only costs their own notes and indexes.
+MULTI_TENANT = os.getenv("VAULT_MULTI_TENANT") == "1"
+TENANTS_DIR = os.getenv("VAULT_TENANTS_DIR", "tenants")
+TENANT_MEMORY_BUDGET_MB = int(os.getenv("VAULT_TENANT_MEMORY_MB", "256"))
+TENANT_MIN_IDLE_SECONDS = 60  # A vault used this recently is never evicted (soft budget)
+NOTE_OVERHEAD_BYTES = 400     # Rough size of a note dict apart from its strings
+
+class Vault:
+    """One vault directory: path-aware storage/config/caches and the shared note list"""
+
+    def __init__(self, root=".", name=None):
+        self.root = root
+        self.name = name
+        os.makedirs(root, exist_ok=True)
+        self.config_path = self.path(CONFIG_FILE)
+        self.rotation_path = self.path(ROTATION_FILE)
+        self.blob_dir = self.path(BLOBS_DIR)
+        self.lock = threading.RLock()  # Per-vault write lock: one writer at a time, across sessions
+        self.version = 0               # Bumped on every note change, keys the sessions' memos
+        self.last_used = time.time()
+        self._storage = None
+        self._notes = None
+        self._note_bytes = 0
+        self._data_version = None
+        self._salt = None
+        self._usage = None
+        self._feedback = None
+        self._sessions = weakref.WeakSet()  # Keyrings of unlocked sessions (closed tabs drop out)
+        self._keyring = None       # The vault's own copy of the key while a session is unlocked
+        self._embed_store = None
+        self._embed_worker = None
+        self._search_index = None
+        self._answer_cache = None
+
+    def path(self, filename):
+        return os.path.join(self.root, filename)
+
+    # PIN & config
+    def is_initialized(self):
+        return is_vault_initialized(self.config_path)
+
+    def initialize(self, pin, recovery_key):
+        initialize_vault(pin, recovery_key, self.config_path)
+        self._salt = None
+
+    def verify_pin(self, pin):
+        return verify_pin(pin, self.config_path)
+
+    def verify_recovery_key(self, recovery_key):
+        return verify_recovery_key(recovery_key, self.config_path)
+
+    def reset_identity(self):
+        """Forgets the PIN (recovery flow); secret notes stay encrypted with the old one"""
+        reset_vault_identity(self.config_path)
+        self._salt = None
+
+    @property
+    def salt(self):
+        """The salt of the current key (cached; a PIN change through this vault resets it)"""
+        if self._salt is None:
+            self._salt = get_vault_salt(self.config_path)
+        return self._salt
+
+    def unlock(self, keyring, pin):
+        keyring.blob_dir = self.blob_dir
+        keyring.unlock(pin, self.salt)
+        self.attach(keyring)
+
+    def keyring_current(self, keyring):
+        """False once the PIN was changed after this keyring was unlocked"""
+        return keyring.is_unlocked and keyring.salt == self.salt
+
+    def pending_rotation(self):
+        return get_pending_rotation(self.rotation_path, self.config_path)
+
+    def check_writable(self, keyring=None, secret=False):
+        """Raises ValueError if a note write now could lose data: during a PIN change, or a
+        secret note encrypted with a key from before the last PIN change"""
+        if self.pending_rotation():
+            raise ValueError("A PIN change is unfinished: resume or roll it back before editing notes")
+        if secret and not (keyring is not None and self.keyring_current(keyring)):
+            raise ValueError("The PIN was changed in another session: unlock again with the new PIN")
+
+    def change_pin(self, old_pin, new_pin, progress=None):
+        with self.lock:
+            try:
+                counts = change_pin(old_pin, new_pin, progress, self.storage, self.config_path, self.rotation_path, self.blob_dir)
+            finally:
+                self._salt = None
+                self._drop_unlocked_state()  # Built with the old key
+                self.reload()
+        return counts
+
+    def rollback_pin_change(self, old_pin, new_pin):
+        with self.lock:
+            try:
+                counts = rollback_pin_change(old_pin, new_pin, None, self.storage, self.config_path, self.rotation_path, self.blob_dir)
+            finally:
+                self._salt = None
+                self._drop_unlocked_state()
+                self.reload()
+        return counts
+
+    # Notes
+    @property
+    def storage(self):
+        if self._storage is None:
+            self._storage = NoteStorage(self.path(NOTES_DB), legacy_file=self.path(NOTES_FILE))
+        return self._storage
+
+    @property
+    def notes(self):
+        """The note list (newest first), loaded on first use and shared by all sessions"""
+        if self._notes is None:
+            with self.lock:
+                if self._notes is None:
+                    self._set_notes(self.storage.load())
+        return self._notes
+
+    def _set_notes(self, notes):
+        self._note_bytes = sum(_note_size(n) for n in notes)
+        self._notes = notes
+        self._data_version = self.storage.data_version()
+
+    def reload(self):
+        with self.lock:
+            self._set_notes(self.storage.load())
+            self.version += 1
+            self._search_index = None  # Rebuilt on the next search
+            if self._embed_worker is not None:
+                self._embed_worker.submit_sync(self._notes)
+
+    def refresh(self):
+        """Reloads the notes if another process wrote to this vault since they were loaded, and
+        drops the shared store/index once no unlocked session is left (e.g. tabs were closed)"""
+        if self._notes is not None and self.storage.data_version() != self._data_version:
+            self.reload()
+        if self._keyring is not None and not self.has_sessions():
+            with self.lock:
+                if not self.has_sessions():
+                    self._drop_unlocked_state()
+
+    def save_note(self, note, keyring=None):
+        """Writes one edited note, or a new one (no 'id' yet: it gets one here), and swaps it
+        into the shared list. keyring is the one
+        a secret note was encrypted with; the write is refused (and a new blob dropped) if it
+        went stale while waiting for the lock, e.g. a PIN change finished in between."""
+        with self.lock:
+            try:
+                self.check_writable(keyring, note.get('secret', False))
+            except ValueError:
+                if note.get('blob') and all(n.get('blob') != note['blob'] for n in self.notes):
+                    delete_blob(self.blob_dir, note['blob'])  # Written by set_note_content just now
+                raise
+            if 'id' not in note:
+                self.storage.insert(note)
+            else:
+                self.storage.upsert(note)
+            notes = list(self.notes)  # Copy-on-write: other sessions may be iterating the old list
+            for i, existing in enumerate(notes):
+                if existing['id'] == note['id']:
+                    self._note_bytes -= _note_size(existing)
+                    if existing.get('blob') and existing['blob'] != note.get('blob'):
+                        delete_blob(self.blob_dir, existing['blob'])  # Only after the new version is committed
+                    notes[i] = note
+                    break
+            else:
+                notes.insert(0, note)
+            self._note_bytes += _note_size(note)
+            self._notes = notes
+            self.version += 1
+            if self._search_index is not None:
+                self._search_index.upsert(note)
+            if self._embed_worker is not None:
+                self._embed_worker.submit_upsert(note)  # Embedded in the background
+            if self._answer_cache is not None:
+                self._answer_cache.invalidate_note(note['id'])
+
+    def delete_note(self, note_id):
+        with self.lock:
+            self.check_writable()
+            self.storage.delete(note_id)
+            removed = [n for n in self.notes if n['id'] == note_id]
+            for note in removed:
+                if note.get('blob'):
+                    delete_blob(self.blob_dir, note['blob'])
+            self._note_bytes -= sum(_note_size(n) for n in removed)
+            self._notes = [n for n in self.notes if n['id'] != note_id]
+            self.version += 1
+            if self._search_index is not None:
+                self._search_index.remove(note_id)
+            if self._embed_worker is not None:
+                self._embed_worker.submit_delete(note_id)
+            if self._answer_cache is not None:
+                self._answer_cache.invalidate_note(note_id)
+
+    # Unlocked sessions and the data they share
+    def attach(self, keyring):
+        """Registers an unlocked session; the first one gives the vault its own copy of the key"""
+        with self.lock:
+            self._sessions.add(keyring)
+            if self._keyring is None or not self.keyring_current(self._keyring):
+                self._drop_unlocked_state()  # Includes a search index built without secret notes
+                self._keyring = keyring.copy()
+
+    def detach(self, keyring):
+        """Call when a session locks: the last one out drops everything built with the key"""
+        with self.lock:
+            self._sessions.discard(keyring)
+            if not self.has_sessions():
+                self._drop_unlocked_state()
+
+    def has_sessions(self):
+        """True while a live session holds the current key"""
+        return any(self.keyring_current(k) for k in list(self._sessions))
+
+    def _drop_unlocked_state(self):
+        if self._embed_worker is not None:
+            self._embed_worker.shutdown(purge=True, wait=False)
+        if self._keyring is not None:
+            self._keyring.lock()
+        self._embed_worker = self._embed_store = self._search_index = self._answer_cache = self._keyring = None
+
+    def embedding_store(self, keyring):
+        """The embedding store shared by the vault's unlocked sessions (keyring: the caller's)"""
+        with self.lock:
+            self.attach(keyring)
+            if self._embed_store is None:
+                self._embed_store = EmbeddingStore(self._keyring, self.path(EMBEDDINGS_DB), self.path(INDEX_FILE),
+                                                   legacy_file=self.path(EMBEDDINGS_FILE))
+            return self._embed_store
+
+    def embedding_worker(self, keyring):
+        """The background worker that keeps the shared store in line with the notes; save_note,
+        delete_note and reload feed it, so sessions only read from the store"""
+        with self.lock:
+            store = self.embedding_store(keyring)
+            if self._embed_worker is None:
+                self._embed_worker = EmbeddingWorker(store)
+                self._embed_worker.submit_sync(self.notes)
+            return self._embed_worker
+
+    def search_index(self):
+        """The full-text index shared by all sessions (secret notes included while one is
+        unlocked), built on first use and kept current by save_note/delete_note"""
+        with self.lock:
+            if self._search_index is None:
+                self._search_index = SearchIndex(self.notes, self._keyring)
+            return self._search_index
+
+    def answer_cache(self, keyring):
+        """The answer cache shared by the vault's unlocked sessions (keyring: the caller's);
+        save_note and delete_note drop the answers a changed note was part of"""
+        with self.lock:
+            self.attach(keyring)
+            if self._answer_cache is None:
+                self._answer_cache = AnswerCache(self._keyring, path=self.path(ANSWER_CACHE_FILE))
+            return self._answer_cache
+
+    # Per-vault files
+
+    @property
+    def usage(self):
+        if self._usage is None:
+            self._usage = UsageTracker(self.path(USAGE_FILE))
+            weakref.finalize(self, self._usage.close)  # Stops its flush thread once the vault is gone
+        return self._usage
+
+    @property
+    def feedback(self):
+        if self._feedback is None:
+            self._feedback = FeedbackLog(self.path(FEEDBACK_FILE), self.path(FEEDBACK_CONTEXTS_FILE),
+                                         legacy_file=self.path(LEGACY_FEEDBACK_FILE))
+        return self._feedback
+
+    def memory_bytes(self):
+        """Rough size of what this vault keeps in memory: note list, embedding store, search index"""
+        total = self._note_bytes + len(self._notes or ()) * NOTE_OVERHEAD_BYTES
+        store, index = self._embed_store, self._search_index
+        if store is not None:
+            total += store.resident_bytes
+        if index is not None:
+            total += index.memory_bytes()
+        return total
+
+    def close(self):
+        """Drops the in-memory notes, store and index (everything reopens lazily) and flushes
+        usage. The tracker itself stays: a running script may still be recording into it."""
+        with self.lock:
+            self._drop_unlocked_state()
+            if self._usage is not None:
+                self._usage.flush()
+            self._notes = None
+            self._note_bytes = 0
+
+def _note_size(note):
+    return len(note.get('title', '')) + len(note.get('content', ''))
+
+_default_vault = None
+_default_vault_lock = threading.Lock()
+
+def get_default_vault():
+    """Single-user vault in the working directory, sharing the module-level storage/usage/feedback"""
+    global _default_vault
+    with _default_vault_lock:
+        if _default_vault is None:
+            vault = Vault(".")
+            vault._storage = get_note_storage()
+            vault._usage = get_usage_tracker()
+            vault._feedback = get_feedback_log()
+            _default_vault = vault
+        return _default_vault
+
+def tenant_dirname(tenant_id):
+    # User ids are e-mails or OIDC subjects: hash them into a safe, fixed-length directory name
+    return hashlib.sha256(tenant_id.encode()).hexdigest()[:32]
+
+class TenantRegistry:
+    """Opens tenant vaults lazily; evicts the least recently used ones over the memory budget"""
+
+    def __init__(self, root=TENANTS_DIR, budget_mb=TENANT_MEMORY_BUDGET_MB, min_idle_seconds=TENANT_MIN_IDLE_SECONDS):
+        self.root = root
+        self.budget_bytes = budget_mb * 1024 * 1024
+        self.min_idle_seconds = min_idle_seconds
+        self.vaults = OrderedDict()  # tenant_id -> Vault held in memory, least recently used first
+        self._alive = weakref.WeakValueDictionary()  # tenant_id -> every Vault still referenced anywhere
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, tenant_id):
+        with self._lock:
+            vault = self.vaults.get(tenant_id)
+            if vault is None:
+                # An evicted vault that a session still references comes back as the same object:
+                # a tenant never gets a second Vault (write lock, usage tracker) next to it
+                vault = self._alive.get(tenant_id)
+                if vault is None:
+                    vault = Vault(os.path.join(self.root, tenant_dirname(tenant_id)), name=tenant_id)
+                    self._alive[tenant_id] = vault
+                self.vaults[tenant_id] = vault
+            self.vaults.move_to_end(tenant_id)
+            vault.last_used = time.time()
+            self._evict()
+            return vault
+
+    def _evict(self):
+        total = sum(v.memory_bytes() for v in self.vaults.values())
+        now = time.time()
+        for tenant_id in list(self.vaults):
+            if total <= self.budget_bytes:
+                break
+            vault = self.vaults[tenant_id]
+            if now - vault.last_used < self.min_idle_seconds:
+                break  # Everything after this one was used even more recently
+            if vault.has_sessions():
+                continue  # Its unlocked sessions are using the store and index
+            total -= vault.memory_bytes()
+            vault.close()
+            del self.vaults[tenant_id]
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {"open_vaults": len(self.vaults), "evictions": self.evictions,
+                    "memory_bytes": sum(v.memory_bytes() for v in self.vaults.values()),
+                    "budget_bytes": self.budget_bytes}
+
+    def close(self):
+        with self._lock:
+            for vault in self.vaults.values():
+                vault.close()
+            self.vaults.clear()
+
+_tenant_registry = None
+_tenant_registry_lock = threading.Lock()
+
+def get_tenant_registry():
+    global _tenant_registry
+    with _tenant_registry_lock:
+        if _tenant_registry is None:
+            _tenant_registry = TenantRegistry()
+        return _tenant_registry